@@ -29,22 +29,26 @@ import tensorflow as tf
 from tensorflow.contrib.legacy_seq2seq import basic_rnn_seq2seq, sequence_loss_by_example, sequence_loss
 import data_utils as data_utils
 from data_utils import  get_embedding_data, LogFileWriter
+from nn_config import LazyDataConfig, embedding_initial_value
 # from sample_vocab import get_sampled_toy_set
-from multiprocessing_generator import ParallelGenerator
+import batch_loader as batch_loader
+import input_pipeline as input_pipeline
+import dynamic_decoder as dynamic_decoder
+import rnn_cells as rnn_cells
+from memory_report import print_memory_report
 from tensorflow.python.ops import variable_scope
 # from preprocessing.preprocessing import pickle_call, pickle_dump
 # from tqdm import *
 #
 
-BASIC = "basic"
-CUDNN = "cudnn"
-BLOCK = "block"
+from rnn_cells import BASIC, CUDNN, BLOCK
 
 def data_type():
   return  tf.float32
 
-class TestConfigToy(object):
-    def __init__(self):
+class TestConfigToy(LazyDataConfig):
+    def __init__(self, location="data/embedding_data/toy_embeddings_epoche_99_lr_1e-05_vectors.bin", vectors=None):
+        super(TestConfigToy, self).__init__(location, vectors)
         self.init_scale = 0.1
         self.learning_rate = 0.001
         self.num_layers = 2
@@ -56,12 +60,11 @@ class TestConfigToy(object):
         self.cell_keep_prob = 0.35
         self.lr_decay = 0.99 # 1 / 1.15 # 0.5
         self.batch_size = 20
-        self.vocab_size = 10000
-        self.embedding_dim = 300
+        self.test_batch_size = 20
+        self.max_vocab_size = 10000
         self.rnn_mode = BLOCK
         self.epoch_size = 100
         self.file_count = -1
-        self.location = "data/embedding_data/toy_embeddings_epoche_99_lr_1e-05_vectors"
         self.cpu = "/cpu:0"
         self.gpu = "/cpu:0"
         self.min_doc_length = 50
@@ -71,10 +74,12 @@ class TestConfigToy(object):
         self.max_gradient_norm = 5.0
         self.train_dir = "data/RNN/"
         self.steps_per_checkpoint = 100
-        self.vocab_size, self.embedding_dim, self.embeddings_mentions_list, self.embeddings_mentions, self.embeddings_np = get_embedding_data(self.location, self.vocab_size)
-        self.train_set , self.test_set, self.validation_set = data_utils.sentences_train_test_validation_splitting_and_paragraph_generation(self.embeddings_mentions,'data/text_data/raw_sentences.txt', splitting=(70,20,10))
-        self.train_args = (self.batch_size, self.buckets, self.train_set)
-        self.test_args = (self.batch_size, self.buckets, self.test_set)
+        self.loader_workers = 4
+        self.loader_prefetch = 8
+        self.input_mode = 'feed'  # or 'dataset' for tf.data iterators
+        self.decoder_mode = 'bucketed'  # or 'dynamic' for one while_loop decoder over all lengths
+        self.encoder_mode = 'static'  # or 'dynamic' to skip the PAD steps of the encoder
+        self.update_mode = 'bucket'  # or 'shared' for one update picking the bucket's loss at run time
         self.generator = data_utils.toy_text_generator
 
 
@@ -93,7 +98,7 @@ class Seq2SeqModel(object):
       http://arxiv.org/abs/1412.2007
     """
 
-    def __init__(self, config, forward_only):
+    def __init__(self, config, forward_only, inputs=None):
         """Create the model.
 
         Args:
@@ -116,6 +121,8 @@ class Seq2SeqModel(object):
           num_samples: number of samples for sampled softmax.
           forward_only: if set, we do not construct the backward pass in the model.
           dtype: the data type to use to store internal variables.
+          inputs: optional input_pipeline.DatasetInputs to build the model on
+            instead of placeholders.
         """
         self.config = config
         # with tf.device(self.config.gpu):
@@ -195,7 +202,7 @@ class Seq2SeqModel(object):
 
         if self.config.use_lstm:
             def single_cell():
-                return tf.contrib.rnn.BasicLSTMCell(self.config.hidden_size)
+                return rnn_cells.lstm_cell(self.config.rnn_mode, self.config.hidden_size)
         cell = single_cell()
 
         if not forward_only and self.config.cell_keep_prob < 1:
@@ -207,14 +214,29 @@ class Seq2SeqModel(object):
 
 
 
+        dynamic_encoder = self.config.encoder_mode == 'dynamic'
+
         def seq2seq_f(encoder_inputs, decoder_inputs, do_decode):
-            return tf.contrib.legacy_seq2seq.tied_rnn_seq2seq(
-                encoder_inputs,
-                decoder_inputs,
-                cell,
-                loop_function = _extract_argmax_and_embed(self.embeddings, do_decode, output_projection=output_projection),
-                # data_type = self.config.dtype
-            )
+            with rnn_cells.forget_bias_scope():
+                if dynamic_encoder:
+                    # tied_rnn_seq2seq with the encoder skipping the PAD steps of the
+                    # [batch_size, length] encoder_inputs.
+                    with variable_scope.variable_scope("combined_tied_rnn_seq2seq"):
+                        encoder_state = dynamic_decoder.dynamic_encoder(cell, self.embeddings, encoder_inputs,
+                                                                        self.config.dtype)
+                        variable_scope.get_variable_scope().reuse_variables()
+                        return tf.contrib.legacy_seq2seq.rnn_decoder(
+                            decoder_inputs, encoder_state, cell,
+                            loop_function=_extract_argmax_and_embed(self.embeddings, do_decode,
+                                                                    output_projection=output_projection),
+                            scope="tied_rnn_seq2seq")
+                return tf.contrib.legacy_seq2seq.tied_rnn_seq2seq(
+                    encoder_inputs,
+                    decoder_inputs,
+                    cell,
+                    loop_function = _extract_argmax_and_embed(self.embeddings, do_decode, output_projection=output_projection),
+                    # data_type = self.config.dtype
+                )
 
         # Feeds for inputs.
         self.targets = []
@@ -222,21 +244,42 @@ class Seq2SeqModel(object):
         self.decoder_inputs = []
         self.target_weights = []
 
-        for i, bucket in enumerate(self.config.buckets):
-            # for i in xrange(self.config.buckets[-1][0]):  # Last bucket is the biggest one.
-            targets_j = []
-            target_weights_j = []
-            for j in xrange(bucket[0]):  # Last bucket is the biggest one.
-                targets_j.append(tf.placeholder(tf.int32, shape=[None],
-                                                          name="targets{0}_{0}".format(i,j)))
-                target_weights_j.append(tf.placeholder(self.config.dtype, shape=[None],
-                                                          name="weight{0}_{0}".format(i)))
-            self.targets.append(targets_j)
-            self.target_weights.append(target_weights_j)
+        # One [batch_size, bucket length] matrix of targets and weights per bucket,
+        # unstacked into the per-timestep vectors the legacy seq2seq functions expect.
+        self.target_matrices = []
+        self.weight_matrices = []
+        dynamic = self.config.decoder_mode == 'dynamic'
+        # With update_mode 'shared' training runs the seq2seq of the bucket fed to bucket_id,
+        # so all buckets share one backward pass and update.
+        shared = self.config.update_mode == 'shared' and not dynamic and not forward_only
+        self.bucket_id = tf.placeholder(tf.int32, shape=[], name="bucket_id") if shared else None
+
+        if shared and inputs is not None:
+            raise ValueError("update_mode 'shared' needs input_mode 'feed'")
+
+        if dynamic or shared:
+            if inputs is not None:
+                raise ValueError("decoder_mode 'dynamic' needs input_mode 'feed'")
+            # A single [batch_size, length] pair of placeholders serves all buckets.
+            self.target_matrices = [tf.placeholder(tf.int32, shape=[None, None], name="targets")] * len(self.config.buckets)
+            self.weight_matrices = [tf.placeholder(self.config.dtype, shape=[None, None], name="weights")] * len(self.config.buckets)
+        else:
+            for i, bucket in enumerate(self.config.buckets):
+                if inputs is not None:
+                    # In dataset mode the targets come straight from the bucket's iterator.
+                    target_matrix = inputs.inputs[i]['targets']
+                    weight_matrix = inputs.inputs[i]['weights']
+                else:
+                    target_matrix = tf.placeholder(tf.int32, shape=[None, bucket[0]], name="targets{0}".format(i))
+                    weight_matrix = tf.placeholder(self.config.dtype, shape=[None, bucket[0]], name="weights{0}".format(i))
+                self.target_matrices.append(target_matrix)
+                self.weight_matrices.append(weight_matrix)
+                self.targets.append(tf.unstack(target_matrix, axis=1))
+                self.target_weights.append(tf.unstack(weight_matrix, axis=1))
 
         with tf.device(self.config.cpu):
 
-            for targets_j in self.targets:
+            for target_matrix, targets_j in zip(self.target_matrices, self.targets):
                 encoder_inputs_j = []
                 decoder_inputs_j = []
                 for j, target in enumerate(targets_j):
@@ -246,7 +289,8 @@ class Seq2SeqModel(object):
                         decoder_inputs_j.append(emb_look)
 
                 decoder_inputs_j.insert(0, tf.nn.embedding_lookup(self.embeddings, np.full(self.config.batch_size, data_utils.GO_ID)))
-                self.encoder_inputs.append(encoder_inputs_j)
+                # The dynamic encoder reads the target matrix instead of the reversed list.
+                self.encoder_inputs.append(target_matrix if dynamic_encoder else encoder_inputs_j)
                 self.decoder_inputs.append(decoder_inputs_j)
 
         # for i in xrange(self.config.buckets[-1][1]):
@@ -263,7 +307,48 @@ class Seq2SeqModel(object):
 
         # with tf.device(self.config.gpu):
         # Training outputs and losses.
-        if forward_only:
+        if dynamic:
+            target_matrix, weight_matrix = self.target_matrices[0], self.weight_matrices[0]
+            # The scopes of tied_rnn_seq2seq, which encodes the reversed targets with
+            # the decoder cell.
+            with variable_scope.variable_scope("combined_tied_rnn_seq2seq",
+                                               custom_getter=rnn_cells.forget_bias_getter):
+                if dynamic_encoder:
+                    encoder_state = dynamic_decoder.dynamic_encoder(cell, self.embeddings, target_matrix,
+                                                                    self.config.dtype)
+                else:
+                    encoder_inputs = tf.reverse(tf.nn.embedding_lookup(self.embeddings, target_matrix), axis=[1])
+                    _, encoder_state = tf.nn.dynamic_rnn(cell, encoder_inputs, dtype=self.config.dtype,
+                                                         scope="tied_rnn_seq2seq")
+                variable_scope.get_variable_scope().reuse_variables()
+                outputs = dynamic_decoder.dynamic_decoder(cell, encoder_state, self.embeddings, target_matrix,
+                                                          weight_matrix, output_projection, feed_previous=forward_only,
+                                                          scope="tied_rnn_seq2seq")
+            loss = dynamic_decoder.sequence_loss(outputs, target_matrix, weight_matrix, output_projection,
+                                                 softmax_loss_function)
+            if forward_only:
+                outputs = dynamic_decoder.project(outputs, output_projection)
+            self.outputs = [outputs] * len(self.config.buckets)
+            self.losses = [loss] * len(self.config.buckets)
+
+        elif shared:
+            def bucket_loss(j):
+                target_matrix = tf.reshape(self.target_matrices[j], [-1, self.config.buckets[j][0]])
+                targets = tf.unstack(target_matrix, axis=1)
+                weights = tf.unstack(tf.reshape(self.weight_matrices[j], [-1, self.config.buckets[j][0]]), axis=1)
+                emb_looks = [tf.nn.embedding_lookup(self.embeddings, target) for target in targets]
+                decoder_inputs = [tf.nn.embedding_lookup(self.embeddings, np.full(self.config.batch_size, data_utils.GO_ID))]
+                decoder_inputs += emb_looks[:-1]
+                encoder_inputs = target_matrix if dynamic_encoder else emb_looks[::-1]
+                outputs, _ = seq2seq_f(encoder_inputs, decoder_inputs, False)
+                return sequence_loss(outputs, targets, weights, softmax_loss_function=softmax_loss_function)
+
+            # No outputs, as the buckets' output lists differ in length; step only fetches the loss.
+            self.outputs = [None] * len(self.config.buckets)
+            self.losses = [dynamic_decoder.select_bucket(self.bucket_id, len(self.config.buckets), bucket_loss)] * \
+                len(self.config.buckets)
+
+        elif forward_only:
             # self.outputs, self.losses = tf.contrib.legacy_seq2seq.model_with_buckets(
             self.outputs, self.losses = self.model_with_buckets(
                 self.encoder_inputs, self.decoder_inputs, self.targets,
@@ -292,16 +377,26 @@ class Seq2SeqModel(object):
             self.updates = []
             # opt = tf.train.GradientDescentOptimizer(self.learning_rate)
             opt = tf.train.AdamOptimizer(self.learning_rate)
-            for b in xrange(len(self.config.buckets)):
-                gradients = tf.gradients(self.losses[b], params)
-                clipped_gradients, norm = tf.clip_by_global_norm(gradients,
-                                                                 self.config.max_gradient_norm)
-                self.gradient_norms.append(norm)
-                self.updates.append(opt.apply_gradients(
-                    zip(clipped_gradients, params), global_step=self.global_step))
+            self.optimizer = opt
+            if dynamic or shared:
+                update, norm = dynamic_decoder.clipped_update(opt, self.losses[0], params,
+                                                              self.config.max_gradient_norm, self.global_step)
+                self.updates = [update] * len(self.config.buckets)
+                self.gradient_norms = [norm] * len(self.config.buckets)
+            else:
+                for b in xrange(len(self.config.buckets)):
+                    gradients = tf.gradients(self.losses[b], params)
+                    clipped_gradients, norm = tf.clip_by_global_norm(gradients,
+                                                                     self.config.max_gradient_norm)
+                    self.gradient_norms.append(norm)
+                    self.updates.append(opt.apply_gradients(
+                        zip(clipped_gradients, params), global_step=self.global_step))
 
         # self.saver = tf.train.Saver(tf.trainable_variables())
-        self.saver = tf.train.Saver(tf.global_variables())
+        # The frozen embeddings are re-initialized from config.embeddings_np after a restore,
+        # the LSTM weights are saved under names every rnn_mode can restore.
+        self.saved_variables = [variable for variable in tf.global_variables() if variable is not self.embeddings]
+        self.saver = tf.train.Saver(rnn_cells.saver_variables(self.saved_variables))
 
     def initializers(self):
         self.const_initializer = tf.constant_initializer([0.0], dtype=data_type())
@@ -314,13 +409,9 @@ class Seq2SeqModel(object):
             # self.embeddings = tf.Variable(tf.constant(0.0, shape=[self.config.vocab_size, self.config.embedding_dim]),
             #                 trainable=False, name="W")
             with tf.name_scope('embedding'):
-                self.embeddings = tf.get_variable(name="Embeddings",
-                                                  shape=[self.config.vocab_size, self.config.embedding_dim],
-                                                  dtype=data_type(), initializer=self.const_initializer,
+                self.embeddings = tf.get_variable(name="Embeddings", dtype=data_type(),
+                                                  initializer=embedding_initial_value(self.config.embeddings_np),
                                                   trainable=False)
-                self.embedding_placeholder = tf.placeholder(data_type(),
-                                                            [self.config.vocab_size, self.config.embedding_dim])
-                self.embedding_init = self.embeddings.assign(self.embedding_placeholder)
 
     # def build_data_tensor(self):
     #     # self.input = tf.Variable(tf.constant(0.0, shape=[self.config.batch_size, self.config.num_steps, self.config.embedding_dim]), trainable=False, name='input')
@@ -379,9 +470,10 @@ class Seq2SeqModel(object):
 
         Args:
           session: tensorflow session to use.
-          encoder_inputs: list of numpy int vectors to feed as encoder inputs.
-          decoder_inputs: list of numpy int vectors to feed as decoder inputs.
-          target_weights: list of numpy float vectors to feed as target weights.
+          encoder_inputs: time-major [length, batch_size] int array to feed as
+            encoder inputs, or None if the model reads its inputs from a DatasetInputs.
+          decoder_inputs: time-major int array to feed as decoder inputs.
+          target_weights: time-major float array to feed as target weights.
           bucket_id: which bucket of the model to use.
           forward_only: whether to do the backward step or only forward.
 
@@ -395,23 +487,24 @@ class Seq2SeqModel(object):
         """
         # Check if the sizes match.
         encoder_size, decoder_size = self.config.buckets[bucket_id]
-        if len(encoder_inputs) != encoder_size:
+        if encoder_inputs is not None and len(encoder_inputs) != encoder_size:
             raise ValueError("Encoder length must be equal to the one in bucket,"
                              " %d != %d." % (len(encoder_inputs), encoder_size))
         # if len(decoder_inputs) != decoder_size:
         #     raise ValueError("Decoder length must be equal to the one in bucket,"
         #                      " %d != %d." % (len(decoder_inputs), decoder_size))
-        if len(target_weights) != decoder_size:
+        if target_weights is not None and len(target_weights) != decoder_size:
             raise ValueError("Weights length must be equal to the one in bucket,"
                              " %d != %d." % (len(target_weights), decoder_size))
 
         # Input feed: encoder inputs, decoder inputs, target_weights, as provided.
+        # In dataset mode they are None, as the graph reads them from its iterators.
         input_feed = {}
-        for l in xrange(encoder_size):
-            input_feed[self.targets[bucket_id][l].name] = encoder_inputs[l]
-        for l in xrange(decoder_size):
-            # input_feed[self.decoder_inputs[l].name] = decoder_inputs[l]
-            input_feed[self.target_weights[bucket_id][l].name] = target_weights[l]
+        if encoder_inputs is not None:
+            if self.bucket_id is not None:
+                input_feed[self.bucket_id] = bucket_id
+            input_feed[self.target_matrices[bucket_id]] = np.asarray(encoder_inputs).T
+            input_feed[self.weight_matrices[bucket_id]] = np.asarray(target_weights).T
 
         # Since our targets are decoder inputs shifted by one, we need one more.
         # last_target = self.decoder_inputs[decoder_size].name
@@ -424,71 +517,42 @@ class Seq2SeqModel(object):
                            self.losses[bucket_id]]  # Loss for this batch.
         else:
             output_feed = [self.losses[bucket_id]]  # Loss for this batch.
-            for l in xrange(decoder_size):  # Output logits.
-                output_feed.append(self.outputs[bucket_id][l])
+            if self.outputs[bucket_id] is None:
+                pass  # The shared training graph only has the loss.
+            elif self.config.decoder_mode == 'dynamic':
+                output_feed.append(self.outputs[bucket_id])  # [batch_size, length, vocab_size] logits.
+            else:
+                for l in xrange(decoder_size):  # Output logits.
+                    output_feed.append(self.outputs[bucket_id][l])
 
         outputs = session.run(output_feed, input_feed)
         if not forward_only:
             return outputs[1], outputs[2], None  # Gradient norm, loss, no outputs.
+        elif self.outputs[bucket_id] is None:
+            return None, outputs[0], None  # No gradient norm, loss, no outputs.
+        elif self.config.decoder_mode == 'dynamic':
+            return None, outputs[0], list(np.swapaxes(outputs[1], 0, 1))  # No gradient norm, loss, outputs.
         else:
             return None, outputs[0], outputs[1:]  # No gradient norm, loss, outputs.
 
 
     def get_batch(self, data, bucket_id):
-        """Get a random batch of data from the specified bucket, prepare for step.
+        """Pad a batch of documents, prepare for step.
 
-        To feed data in step(..) it must be a list of batch-major vectors, while
-        data here contains single length-major cases. So the main logic of this
-        function is to re-index data cases to be in the proper format for feeding.
+        To feed data in step(..) it must be time-major, while data here contains
+        single length-major cases. The padding and re-indexing is done by
+        data_utils.pad_batch in one vectorized pass.
 
         Args:
-          data: a tuple of size len(self.buckets) in which each element contains
-            lists of pairs of input and output data that we use to create a batch.
-          bucket_id: integer, which bucket to get the batch for.
+          data: list of at most batch_size token id documents.
+          bucket_id: integer, which bucket to pad the documents for.
 
         Returns:
-          The triple (encoder_inputs, decoder_inputs, target_weights) for
-          the constructed batch that has the proper format to call step(...) later.
+          The pair (inputs, weights) of [length, batch_size] arrays that has the
+          proper format to call step(...) later.
         """
         encoder_size, decoder_size = self.config.buckets[bucket_id]
-        encoder_inputs =  []
-
-        # Get a random batch of encoder and decoder inputs from data,
-        # pad them if needed, reverse encoder inputs and add GO to decoder.
-        for d in data:
-
-            # Encoder inputs are padded and then reversed.
-            encoder_pad = [data_utils.PAD_ID] * (encoder_size - len(d))
-            encoder_inputs.append(list(d + encoder_pad))
-
-        while len(encoder_inputs) < self.config.batch_size:
-            encoder_inputs.append([data_utils.PAD_ID] * encoder_size)
-
-        # Now we create batch-major vectors from the data selected above.
-        batch_encoder_inputs,  batch_weights = [], []
-
-        # Batch encoder inputs are just re-indexed encoder_inputs.
-        for length_idx in xrange(encoder_size):
-            try:
-                batch_encoder_inputs.append(
-                    np.array([encoder_inputs[batch_idx][length_idx]
-                              for batch_idx in xrange(self.config.batch_size)], dtype=np.int32))
-            except:
-                pass
-
-            batch_weight = np.ones(self.config.batch_size, dtype=np.float32)
-            for batch_idx in xrange(self.config.batch_size):
-                # We set weight to 0 if the corresponding target is a PAD symbol.
-                # The corresponding target is decoder_input shifted by 1 forward.
-                if encoder_inputs[batch_idx][length_idx] == data_utils.PAD_ID:
-                    batch_weight[batch_idx] = 0.0
-            batch_weights.append(batch_weight)
-        # batch_weights.append(np.zeros(self.config.batch_size, dtype=np.float32))
-
-        if np.array(batch_encoder_inputs).size != np.array(batch_weights).size:
-            pass
-
-        return batch_encoder_inputs, batch_weights
+        return data_utils.pad_batch(data, encoder_size, self.config.batch_size)
 
     def model_with_buckets(self, encoder_inputs,
                            decoder_inputs,
@@ -571,16 +635,17 @@ class Seq2SeqModel(object):
         return outputs, losses
 
 
-def create_model(session, config, forward_only):
+def create_model(session, config, forward_only, inputs=None):
     """Create translation model and initialize or load parameters in session."""
 
     # dtype = tf.float16 if FLAGS.use_fp16 else tf.float32
-    model = Seq2SeqModel(config, forward_only)
+    model = Seq2SeqModel(config, forward_only, inputs)
     ckpt = tf.train.get_checkpoint_state(config.train_dir)
     # print (ckpt.model_checkpoint_path)
-    if ckpt and tf.train.checkpoint_exists(ckpt.model_checkpoint_path):
-        print("Reading model parameters from %s" % ckpt.model_checkpoint_path)
-        model.saver.restore(session, ckpt.model_checkpoint_path)
+    if ckpt and tf.train.checkpoint_exists(ckpt.model_checkpoint_path) and \
+            rnn_cells.restore(session, model.saved_variables, ckpt.model_checkpoint_path):
+        print("Read model parameters from %s" % ckpt.model_checkpoint_path)
+        session.run(model.embeddings.initializer)
     else:
         print("Created model with fresh parameters.")
         session.run(tf.global_variables_initializer())
@@ -600,14 +665,14 @@ def train(config, forward_only, train_log_file, test_log_file):
     # config.gpu_options.per_process_gpu_memory_fraction = 0.99
     sess_config.gpu_options.allow_growth = True
 
-    with tf.Session(config=sess_config) as sess:
-        # with tf.Session() as sess:
-        # Create model.
-        print("Creating %d layers of %d units." % (config.num_layers, config.hidden_size))
+    sess = tf.Session(config=sess_config)
+    # with tf.Session() as sess:
+    # Create model.
+    print("Creating %d layers of %d units." % (config.num_layers, config.hidden_size))
 
-        vocab_size = config.vocab_size
-        print('getting embeddings')
-        # embeddings_mentions, embeddings, embeddings_mentions_list = data_utils.get_embedding_data(location, vocab_size)
+    vocab_size = config.vocab_size
+    print('getting embeddings')
+    # embeddings_mentions, embeddings, embeddings_mentions_list = data_utils.get_embedding_data(location, vocab_size)
 
     # train_set, test_set = doc_bucket_seperator(mongodb_name, _buckets, embeddings_mentions, train_test_perc=0.80,
     #                                            nr_docs=100)
@@ -615,11 +680,13 @@ def train(config, forward_only, train_log_file, test_log_file):
     # config.vocab_size = len(embeddings)
     # config.embedding_dim = len(embeddings[0])
 
+    inputs = input_pipeline.dataset_inputs(config)
+
     print('building model')
-    model = create_model(sess,config, forward_only)
+    model = create_model(sess,config, forward_only, inputs)
 
 
-    sess.run(model.embedding_init, {model.embedding_placeholder: model.config.embeddings_np})
+    print_memory_report(config, model)
 
     # train_set, dev_set = data_utils.bucket_generator(mongodb_name, config.buckets, max_len, embeddings_mentions, train_length,
     #                                                  test_length)
@@ -634,6 +701,7 @@ def train(config, forward_only, train_log_file, test_log_file):
 
     # This is the training loop.
     step_time, single_step_time, loss, single_step_loss = 0.0, 0.0, 0.0, 0.0
+    tokens = 0.0
     current_step = 0
     previous_losses = []
 
@@ -644,100 +712,106 @@ def train(config, forward_only, train_log_file, test_log_file):
         test_log_file.append_text('Epoch: ' + str(epoch))
 
         # generator = new_bucket_generator(mongodb_name, config.buckets, train_set, embeddings_mentions, 4)
-        generator = config.generator(*config.train_args)
-
         # while True:
             # Choose a bucket according to data distribution. We pick a random number
             # in [0, 1] and use the corresponding interval in train_buckets_scale.
 
             # batch, bucket_id = generator.next()
 
-        with ParallelGenerator(generator, max_lookahead=3, get_timeout=60) as batch_gen_lookahead:
-            for batch, bucket_id in batch_gen_lookahead:
-
-                if batch is None: break
-
-                # Get a batch and make a step.
-                start_time = time.time()
-
-                encoder_inputs,  target_weights = model.get_batch(batch, bucket_id)
-
-                _, step_loss, _ = model.step(sess, encoder_inputs,
-                                             target_weights, bucket_id, False)
-                step_time += (time.time() - start_time) / config.steps_per_checkpoint
-                single_step_time += (time.time() - start_time) / (config.steps_per_checkpoint / 100)
-                loss += step_loss / config.steps_per_checkpoint
-                single_step_loss += step_loss / (config.steps_per_checkpoint / 100)
-                current_step += 1
-
-
-                # Once in a while, we save checkpoint, print statistics, and run evals.
-
-                # if current_step % config.steps_per_checkpoint == 0:
-                #     perplexity = math.exp(float(loss)) if loss < 300 else float("inf")
-                #     print("global step %d learning rate %.4f step-time %.2f perplexity "
-                #           "%.2f" % (model.global_step.eval(session=sess), model.learning_rate.eval(session=sess),
-                #                     step_time, perplexity))
-                #     # Decrease learning rate if no improvement was seen over last 3 times.
-                #     if len(previous_losses) > 2 and loss > max(previous_losses[-3:]):
-                #         sess.run(model.learning_rate_decay_op)
-                #     previous_losses.append(loss)
-                #     train_log_file.append_text(
-                #         str(model.global_step.eval(session=sess)) + ';' + str(perplexity) + ';' + str(loss) + ';' + str(
-                #             model.learning_rate.eval(session=sess)) + ';' + str(step_time))
-                #
-                #     step_time, loss = 0.0, 0.0
-                #     # Save checkpoint and zero timer and loss.
-                #     # checkpoint_path = os.path.join(config.train_dir, "translate.ckpt")
-                #     # model.saver.save(sess, checkpoint_path, global_step=model.global_step)
-                #     # Run evals on development set and print their perplexity.
-                #
-                #
-                #
-                # if current_step % (config.steps_per_checkpoint / 100) == 0:
-                #     # Print statistics for the previous epoch.
-                #     perplexity = math.exp(float(single_step_loss)) if single_step_loss < 300 else float("inf")
-                #     print("global step %d learning rate %.4f step-time %.2f perplexity "
-                #           "%.2f" % (model.global_step.eval(session=sess), model.learning_rate.eval(session=sess),
-                #                     single_step_time, perplexity))
-                #     single_step_time, single_step_loss = 0.0, 0.0
-
-
-                if current_step % config.steps_per_checkpoint == 0:
-                    # loss = loss / checkpoint_counter
-                    perplexity = math.exp(float(loss)) if loss < 300 else float("inf")
-                    print("global step %d learning rate %.4f step-time %.2f perplexity "
-                          "%.2f" % (model.global_step.eval(session=sess), model.learning_rate.eval(session=sess),
-                                    step_time, perplexity))
-                    # Decrease learning rate if no improvement was seen over last 3 times.
-                    # if len(previous_losses) > 2 and loss > max(previous_losses[-3:]):
-                    #     sess.run(model.learning_rate_decay_op)
-                    # previous_losses.append(loss)
-                    train_log_file.append_text(str(model.global_step.eval(session=sess)) + ';' + str(perplexity) + ';' + str(loss) + ';' + str(model.learning_rate.eval(session=sess)) + ';' + str(step_time))
-                    step_time, loss = 0.0, 0.0
+        if inputs is not None:
+            batches = input_pipeline.dataset_batches(inputs, sess, 'train')
+        else:
+            batches = batch_loader.batches(config, config.train_args, epoch=epoch)
+
+        for _, encoder_inputs, target_weights, bucket_id in batches:
+
+            # Get a batch and make a step.
+            start_time = time.time()
+
+            _, step_loss, _ = model.step(sess, encoder_inputs,
+                                         target_weights, bucket_id, False)
+            step_time += (time.time() - start_time) / config.steps_per_checkpoint
+            # Non-padding target tokens; in dataset mode the mask stays in the graph and
+            # the full bucket is counted.
+            tokens += np.sum(target_weights) if target_weights is not None else \
+                config.batch_size * config.buckets[bucket_id][0]
+            single_step_time += (time.time() - start_time) / (config.steps_per_checkpoint / 100)
+            loss += step_loss / config.steps_per_checkpoint
+            single_step_loss += step_loss / (config.steps_per_checkpoint / 100)
+            current_step += 1
+
+
+            # Once in a while, we save checkpoint, print statistics, and run evals.
+
+            # if current_step % config.steps_per_checkpoint == 0:
+            #     perplexity = math.exp(float(loss)) if loss < 300 else float("inf")
+            #     print("global step %d learning rate %.4f step-time %.2f perplexity "
+            #           "%.2f" % (model.global_step.eval(session=sess), model.learning_rate.eval(session=sess),
+            #                     step_time, perplexity))
+            #     # Decrease learning rate if no improvement was seen over last 3 times.
+            #     if len(previous_losses) > 2 and loss > max(previous_losses[-3:]):
+            #         sess.run(model.learning_rate_decay_op)
+            #     previous_losses.append(loss)
+            #     train_log_file.append_text(
+            #         str(model.global_step.eval(session=sess)) + ';' + str(perplexity) + ';' + str(loss) + ';' + str(
+            #             model.learning_rate.eval(session=sess)) + ';' + str(step_time))
+            #
+            #     step_time, loss = 0.0, 0.0
+            #     # Save checkpoint and zero timer and loss.
+            #     # checkpoint_path = os.path.join(config.train_dir, "translate.ckpt")
+            #     # model.saver.save(sess, checkpoint_path, global_step=model.global_step)
+            #     # Run evals on development set and print their perplexity.
+            #
+            #
+            #
+            # if current_step % (config.steps_per_checkpoint / 100) == 0:
+            #     # Print statistics for the previous epoch.
+            #     perplexity = math.exp(float(single_step_loss)) if single_step_loss < 300 else float("inf")
+            #     print("global step %d learning rate %.4f step-time %.2f perplexity "
+            #           "%.2f" % (model.global_step.eval(session=sess), model.learning_rate.eval(session=sess),
+            #                     single_step_time, perplexity))
+            #     single_step_time, single_step_loss = 0.0, 0.0
+
+
+            if current_step % config.steps_per_checkpoint == 0:
+                # loss = loss / checkpoint_counter
+                perplexity = math.exp(float(loss)) if loss < 300 else float("inf")
+                print("global step %d learning rate %.4f step-time %.2f perplexity "
+                      "%.2f" % (model.global_step.eval(session=sess), model.learning_rate.eval(session=sess),
+                                step_time, perplexity))
+                # Decrease learning rate if no improvement was seen over last 3 times.
+                # if len(previous_losses) > 2 and loss > max(previous_losses[-3:]):
+                #     sess.run(model.learning_rate_decay_op)
+                # previous_losses.append(loss)
+                train_log_file.log(step=model.global_step.eval(session=sess), perplexity=perplexity, loss=loss,
+                                   learning_rate=model.learning_rate.eval(session=sess), step_time=step_time,
+                                   tokens_per_sec=tokens / (step_time * config.steps_per_checkpoint))
+                step_time, loss, tokens = 0.0, 0.0, 0.0
 
 
 
         checkpoint_path = os.path.join(config.train_dir, "translate.ckpt")
         model.saver.save(sess, checkpoint_path, global_step=model.global_step)
 
-        test_generator = config.generator(*config.test_args)
-
-
         print("Testing:")
-        with ParallelGenerator(test_generator, max_lookahead=10) as batch_gen_lookahead:
-            for batch, bucket_id in batch_gen_lookahead:
-                if batch == None: break
+        if inputs is not None:
+            batches = input_pipeline.dataset_batches(inputs, sess, 'test')
+        else:
+            batches = batch_loader.batches(config, config.test_args)
 
-                encoder_inputs, target_weights = model.get_batch(batch, bucket_id)
-                _, eval_loss, _ = model.step(sess, encoder_inputs, target_weights, bucket_id, True)
-                eval_ppx = math.exp(float(eval_loss)) if eval_loss < 300 else float(
-                    "inf")
-                print("  eval: bucket %d perplexity %.2f" % (bucket_id, eval_ppx))
-                test_log_file.append_text(str(bucket_id) + ';' + str(eval_ppx) + ';' + str(eval_loss))
+        for _, encoder_inputs, target_weights, bucket_id in batches:
+            _, eval_loss, _ = model.step(sess, encoder_inputs, target_weights, bucket_id, True)
+            eval_ppx = math.exp(float(eval_loss)) if eval_loss < 300 else float(
+                "inf")
+            print("  eval: bucket %d perplexity %.2f" % (bucket_id, eval_ppx))
+            test_log_file.log(bucket=bucket_id, perplexity=eval_ppx, loss=eval_loss)
 
         step_time, loss = 0.0, 0.0
         sys.stdout.flush()
+        train_log_file.flush()
+        test_log_file.flush()
+
+    sess.close()
 
 def decode(config):
     with tf.Session() as sess:
@@ -819,6 +893,8 @@ if __name__ == '__main__':
 
 
         train(train_config, False, train_log_file, test_log_file)
+        train_log_file.close()
+        test_log_file.close()
 
         tf.reset_default_graph()
 
@@ -0,0 +1,164 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import ctypes
+import traceback
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+from six.moves import queue
+from six.moves import xrange  # pylint: disable=redefined-builtin
+from multiprocessing_generator import ParallelGenerator
+import data_utils as data_utils
+from data_utils import pad_batch
+
+
+class _Slot(object):
+    """One ring buffer entry: shared int32 encoder/decoder matrices and a float32 weight mask."""
+
+    def __init__(self, rows, max_length, encoder_length):
+        self.rows = rows
+        self.encoder_length = encoder_length
+        self.decoder = np.ctypeslib.as_array(RawArray(ctypes.c_int32, rows * max_length))
+        self.weights = np.ctypeslib.as_array(RawArray(ctypes.c_float, rows * max_length))
+        if encoder_length:
+            self.encoder = np.ctypeslib.as_array(RawArray(ctypes.c_int32, rows * encoder_length))
+
+    def buffers(self, length):
+        """Batch-major [rows, length] arrays at the start of the shared buffers."""
+        size = self.rows * length
+        return self.decoder[:size].reshape(self.rows, length), self.weights[:size].reshape(self.rows, length)
+
+    def encoder_buffer(self, length):
+        """Batch-major [rows, length] encoder matrix at the start of the shared buffer."""
+        return self.encoder[:self.rows * length].reshape(self.rows, length)
+
+
+def _fill_slots(data_set, data_buckets, schedule, buckets, encoder_lengths, rows, slots, free_slots, full_slots):
+    """Worker loop: pads every scheduled batch into the next free slot."""
+    try:
+        encoder_weights = {}
+        for bucket_nr, start, end in schedule:
+            batch = [data_set[i] for i in data_buckets[bucket_nr][start:end]]
+            slot_nr = free_slots.get()
+            slot = slots[slot_nr]
+            pad_batch(batch, buckets[bucket_nr][0], rows, out=slot.buffers(buckets[bucket_nr][0]))
+            if encoder_lengths:
+                length = encoder_lengths[bucket_nr]
+                if length not in encoder_weights:
+                    encoder_weights[length] = np.empty((rows, length), dtype=np.float32)
+                pad_batch(batch, length, rows, out=(slot.encoder_buffer(length), encoder_weights[length]))
+            full_slots.put((slot_nr, bucket_nr))
+    except Exception:
+        full_slots.put((None, traceback.format_exc()))
+
+
+class SharedBatchLoader(object):
+    """Pads the batches of a FlatCorpus in worker processes into shared memory.
+
+    The epoch's batches are scheduled up front by data_utils.bucket_schedule and
+    dealt round-robin to num_workers processes, so every document fitting into a
+    bucket is seen exactly once per iteration over the loader. Workers write the
+    padded int32 matrices and float32 weight masks into a ring of prefetch
+    shared-memory slots and the trainer reads them in place.
+
+    Iterating yields (encoder_inputs, decoder_inputs, target_weights, bucket_id)
+    tuples of time-major views like the ones returned by data_utils.pad_batch;
+    encoder_inputs is None without an encoder_length, which is one length for all
+    buckets or a list with the length of every bucket. The views are only valid
+    until the next tuple is requested, as their slot is then handed back to the
+    workers.
+    """
+
+    def __init__(self, batch_size, buckets, data_set, encoder_length=None, num_workers=4, prefetch=8,
+                 rows=None, timeout=1.0):
+        self.batch_size = batch_size
+        self.buckets = buckets
+        self.data_set = data_set
+        self.encoder_lengths = data_utils.bucket_encoder_lengths(encoder_length, buckets)
+        self.num_workers = num_workers
+        self.rows = rows or batch_size
+        self.timeout = timeout
+        self.slots = [_Slot(self.rows, buckets[-1][0], max(self.encoder_lengths or [0]))
+                      for _ in xrange(max(prefetch, 1))]
+
+    def __iter__(self):
+        data_buckets = data_utils.bucket_documents(self.buckets, self.data_set)
+        schedule = data_utils.bucket_schedule([len(data_) for data_ in data_buckets], self.batch_size)
+
+        free_slots = multiprocessing.Queue()
+        full_slots = multiprocessing.Queue()
+        for slot_nr in xrange(len(self.slots)):
+            free_slots.put(slot_nr)
+
+        workers = [multiprocessing.Process(target=_fill_slots,
+                                           args=(self.data_set, data_buckets, schedule[w::self.num_workers],
+                                                 self.buckets, self.encoder_lengths, self.rows, self.slots,
+                                                 free_slots, full_slots))
+                   for w in xrange(self.num_workers)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        try:
+            for _ in xrange(len(schedule)):
+                while True:
+                    try:
+                        slot_nr, bucket_nr = full_slots.get(timeout=self.timeout)
+                        break
+                    except queue.Empty:
+                        if not any(worker.is_alive() for worker in workers):
+                            raise RuntimeError("batch loader workers exited before the epoch was complete")
+                if slot_nr is None:
+                    raise RuntimeError("batch loader worker failed:\n" + bucket_nr)
+
+                slot = self.slots[slot_nr]
+                decoder_inputs, target_weights = slot.buffers(self.buckets[bucket_nr][0])
+                encoder_inputs = slot.encoder_buffer(self.encoder_lengths[bucket_nr]).T \
+                    if self.encoder_lengths else None
+
+                yield encoder_inputs, decoder_inputs.T, target_weights.T, bucket_nr
+
+                free_slots.put(slot_nr)
+
+            for worker in workers:
+                worker.join()
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+
+
+def generator_batches(generator, batch_size, buckets, encoder_length=None, max_lookahead=10):
+    """Pads the (batch, bucket_id) pairs of a generator running in a ParallelGenerator.
+
+    This is the fallback of SharedBatchLoader for data sets without random access,
+    e.g. a data_utils.ParagraphStream, and yields the same tuples.
+    """
+    encoder_lengths = data_utils.bucket_encoder_lengths(encoder_length, buckets)
+    with ParallelGenerator(generator, max_lookahead=max_lookahead) as batch_gen_lookahead:
+        for batch, bucket_id in batch_gen_lookahead:
+            if batch is None:
+                break
+
+            encoder_inputs = pad_batch(batch, encoder_lengths[bucket_id], batch_size)[0] if encoder_lengths else None
+            decoder_inputs, target_weights = pad_batch(batch, buckets[bucket_id][0], batch_size)
+
+            yield encoder_inputs, decoder_inputs, target_weights, bucket_id
+
+
+def batches(config, args, encoder_length=None, epoch=0):
+    """Yields the padded batches of the (batch_size, buckets, data_set) args of a config.
+
+    FlatCorpus data sets go through a SharedBatchLoader with config.loader_workers
+    processes and config.loader_prefetch slots, everything else through
+    config.generator and generator_batches. The epoch is passed to config.generator,
+    which picks the paragraphs of a ParagraphStream with it.
+    """
+    batch_size, buckets, data_set = args
+    if config.loader_workers > 0 and isinstance(data_set, data_utils.FlatCorpus):
+        return SharedBatchLoader(batch_size, buckets, data_set, encoder_length, config.loader_workers,
+                                 config.loader_prefetch, rows=config.batch_size)
+    return generator_batches(config.generator(batch_size, buckets, data_set, epoch), config.batch_size, buckets,
+                             encoder_length)
@@ -0,0 +1,278 @@
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+
+def word2vec(file_name='data/text_data/raw_sentences.txt', workers=(1, 4, 24), epochs=3, shuffles=2):
+    """Words/sec of GensimW2VToy fed by the Python iterator and in corpus_file mode.
+
+    The line sentence copies of corpus_file mode are written by the first build_dict
+    and reused by the other worker counts, so its build time includes the writes.
+    """
+    from gensim_w2v_toy import GensimW2VToy
+
+    directory = tempfile.mkdtemp()
+    try:
+        for corpus_file in (False, True):
+            for nr_workers in workers:
+                w2v = GensimW2VToy(file_name, os.path.join(directory, 'w2v'), size=50, window=5, min_count=0,
+                                   workers=nr_workers, corpus_file=corpus_file, cache_dir=directory,
+                                   shuffles=shuffles)
+                start_time = time.time()
+                w2v.build_dict(file_name)
+                build_time = time.time() - start_time
+
+                words, start_time = 0, time.time()
+                for epoch in range(epochs):
+                    words += w2v.train_epoch(epoch, 0.025, 0.0001)[1]
+                elapsed = time.time() - start_time
+
+                print("word2vec corpus_file=%s workers=%d: build_dict %.1fs, %d epochs at %.0f words/sec, "
+                      "%.0f words/sec with build_dict" % (corpus_file, nr_workers, build_time, epochs,
+                                                          words / elapsed, words / (elapsed + build_time)))
+    finally:
+        shutil.rmtree(directory)
+
+
+def config_startup(location=None):
+    """Seconds until a config is usable for decoding, for training and for the next run of a sweep."""
+    start_time = time.time()
+    from nn_config import TestConfigToy
+    print("import nn_config: %.2fs" % (time.time() - start_time))
+
+    def timed(name, load):
+        start_time = time.time()
+        load(TestConfigToy(location) if location else TestConfigToy())
+        print("%s: %.2fs" % (name, time.time() - start_time))
+
+    timed("create config", lambda config: config)
+    timed("decode (embeddings)", lambda config: config.embeddings_mentions)
+    timed("train (data sets)", lambda config: config.train_set)
+    timed("next sweep config (cached)", lambda config: (config.embeddings_np, config.train_set))
+
+
+def _random_batch(config, length, rows):
+    """Time-major random token ids and full weights, like data_utils.pad_batch returns them."""
+    import numpy as np
+    inputs = np.random.randint(3, config.vocab_size, size=(length, rows)).astype(np.int32)
+    return inputs, np.ones((length, rows), dtype=np.float32)
+
+
+def _build_model(name, config):
+    """Builds the DilatedCNN or Seq2SeqModel of a config and returns (model, step)."""
+    if name == 'dcnn':
+        import dCNN2RNN
+        layers, config.cap = dCNN2RNN.needed_layers(config)
+        model = dCNN2RNN.DilatedCNN(config, False, layers)
+
+        def step(session, bucket_id, forward_only=False):
+            encoder_inputs, _ = _random_batch(config, dCNN2RNN.bucket_caps(config)[bucket_id], config.batch_size)
+            decoder_inputs, weights = _random_batch(config, config.buckets[bucket_id][0], config.batch_size)
+            return model.step(session, encoder_inputs, decoder_inputs, weights, bucket_id, forward_only)
+    else:
+        import RNN2RNN
+        model = RNN2RNN.Seq2SeqModel(config, False)
+
+        def step(session, bucket_id, forward_only=False):
+            inputs, weights = _random_batch(config, config.buckets[bucket_id][0], config.batch_size)
+            return model.step(session, inputs, weights, bucket_id, forward_only)
+    return model, step
+
+
+def _time_steps(name, config, steps, evaluate=False):
+    """Builds the model of config and returns (build time, graph ops, train step time per bucket).
+
+    With evaluate every bucket also runs a forward only step of the training model,
+    as the test pass at the end of train does.
+    """
+    import tensorflow as tf
+
+    start_time = time.time()
+    model, step = _build_model(name, config)
+    build_time = time.time() - start_time
+    nr_ops = len(tf.get_default_graph().get_operations())
+
+    with tf.Session() as session:
+        session.run(tf.global_variables_initializer())
+        step_times = []
+        for bucket_id in range(len(config.buckets)):
+            step(session, bucket_id)  # warm up
+            start_time = time.time()
+            for _ in range(steps):
+                step(session, bucket_id)
+            step_times.append((time.time() - start_time) / steps)
+            if evaluate:
+                step(session, bucket_id, True)
+    return build_time, nr_ops, step_times
+
+
+def _new_config(name):
+    import nn_config
+    import RNN2RNN
+    return nn_config.TestConfigToy() if name == 'dcnn' else RNN2RNN.TestConfigToy()
+
+
+def decoder_modes(models=('dcnn', 'rnn'), modes=('bucketed', 'dynamic'), steps=20):
+    """Graph build time, graph size and train step time of the bucketed and the dynamic decoder."""
+    import tensorflow as tf
+
+    for name in models:
+        for mode in modes:
+            tf.reset_default_graph()
+            config = _new_config(name)
+            config.decoder_mode = mode
+
+            build_time, nr_ops, step_times = _time_steps(name, config, steps)
+            print("%s %s decoder: build %.1fs, %d ops, step time per bucket %s" % (
+                name, mode, build_time, nr_ops, ' '.join('%.3fs' % step_time for step_time in step_times)))
+
+
+def rnn_modes(models=('dcnn', 'rnn'), modes=('basic', 'block', 'cudnn'), steps=20):
+    """CPU train step time and memory growth of every LSTM engine."""
+    import tensorflow as tf
+    from memory_report import resident_bytes
+
+    for name in models:
+        for mode in modes:
+            tf.reset_default_graph()
+            config = _new_config(name)
+            config.rnn_mode = mode
+            config.embeddings_np  # load the data before measuring memory
+
+            start_bytes = resident_bytes()
+            with tf.device('/cpu:0'):
+                build_time, nr_ops, step_times = _time_steps(name, config, steps)
+            print("%s %s cells: build %.1fs, %d ops, resident +%.1f MB, step time per bucket %s" % (
+                name, mode, build_time, nr_ops, (resident_bytes() - start_bytes) / 2.0 ** 20,
+                ' '.join('%.3fs' % step_time for step_time in step_times)))
+
+
+def encoder_caps(engines=('conv2d', 'conv1d'), steps=20):
+    """dCNN train step time per bucket with the global encoder cap and with per-bucket caps."""
+    import tensorflow as tf
+    import nn_config
+    import dCNN2RNN
+
+    for engine in engines:
+        for bucket_caps in (False, True):
+            tf.reset_default_graph()
+            config = nn_config.TestConfigToy()
+            config.encoder_engine = engine
+            config.bucket_caps = bucket_caps
+
+            build_time, nr_ops, step_times = _time_steps('dcnn', config, steps)
+            print("%s encoder caps %s: build %.1fs, %d ops, step time per bucket %s" % (
+                engine, ' '.join(str(cap) for cap in dCNN2RNN.bucket_caps(config)), build_time, nr_ops,
+                ' '.join('%.3fs' % step_time for step_time in step_times)))
+
+
+def encoder_engines(engines=('conv2d', 'conv1d'), steps=50):
+    """FLOPs per row and forward latency of the dCNN encoder engines, sized for every bucket."""
+    import tensorflow as tf
+    import nn_config
+    import dCNN2RNN
+    import dilated_conv
+
+    for engine in engines:
+        for bucket in nn_config.TestConfigToy().buckets:
+            tf.reset_default_graph()
+            config = nn_config.TestConfigToy()
+            config.encoder_engine = engine
+            config.buckets = [bucket]
+            layers, config.cap = dCNN2RNN.needed_layers(config)
+            model = dCNN2RNN.DilatedCNN(config, True, layers)
+            plan = dilated_conv.exact_plan if engine == 'conv1d' else dilated_conv.doubling_plan
+            flops = dilated_conv.encoder_flops(config.cap, plan(bucket[0])[0], config.embedding_dim,
+                                               config.hidden_size * config.num_layers)
+
+            with tf.Session() as session:
+                session.run(tf.global_variables_initializer())
+                encoder_inputs, _ = _random_batch(config, config.cap, config.batch_size)
+                feed = {model.encoder_inputs_positions: encoder_inputs.T}
+                session.run(model.encoder_outputs[-1], feed)  # warm up
+                start_time = time.time()
+                for _ in range(steps):
+                    session.run(model.encoder_outputs[-1], feed)
+                latency = (time.time() - start_time) / steps
+
+            print("%s encoder bucket %d: cap %d, %d layers, %.1f MFLOPs per row, %.2fms per batch" % (
+                engine, bucket[0], config.cap, layers, flops / 1e6, latency * 1000))
+
+
+def update_modes(models=('dcnn', 'rnn'), modes=('bucket', 'shared'), nr_buckets=(4, 8, 16), steps=10):
+    """Graph build time, graph size, memory growth and mean step time of per-bucket and shared updates."""
+    import tensorflow as tf
+    from memory_report import resident_bytes
+
+    for name in models:
+        for n in nr_buckets:
+            for mode in modes:
+                tf.reset_default_graph()
+                config = _new_config(name)
+                max_length = config.buckets[-1][0]
+                config.buckets = [(length, length) for length in
+                                  sorted(set(int(round(max_length * (i + 1.0) / n)) for i in range(n)))]
+                config.update_mode = mode
+                config.embeddings_np  # load the data before measuring memory
+
+                start_bytes = resident_bytes()
+                build_time, nr_ops, step_times = _time_steps(name, config, steps, evaluate=True)
+                graph_bytes = tf.get_default_graph().as_graph_def().ByteSize()
+                print("%s %d buckets %s update: build %.1fs, %d ops, graph %.1f MB, resident +%.1f MB, "
+                      "mean step time %.3fs" % (name, len(config.buckets), mode, build_time, nr_ops,
+                                                graph_bytes / 2.0 ** 20, (resident_bytes() - start_bytes) / 2.0 ** 20,
+                                                sum(step_times) / len(step_times)))
+
+
+def encoder_modes(modes=('static', 'dynamic'), steps=200):
+    """RNN2RNN train tokens/sec of the padded and the length-aware encoder on the toy training batches."""
+    import itertools
+    import numpy as np
+    import tensorflow as tf
+    import batch_loader
+    import RNN2RNN
+
+    for mode in modes:
+        tf.reset_default_graph()
+        config = RNN2RNN.TestConfigToy()
+        config.encoder_mode = mode
+        model = RNN2RNN.Seq2SeqModel(config, False)
+
+        with tf.Session() as session:
+            session.run(tf.global_variables_initializer())
+            # The loader reuses its buffers, keep copies to replay the same batches.
+            batches = [(None, np.array(encoder_inputs), np.array(target_weights), bucket_id)
+                       for _, encoder_inputs, target_weights, bucket_id in
+                       itertools.islice(batch_loader.batches(config, config.train_args), steps)]
+            warm_up = dict((bucket_id, batch) for batch in reversed(batches) for bucket_id in [batch[3]])
+            for _, encoder_inputs, target_weights, bucket_id in warm_up.values():
+                model.step(session, encoder_inputs, target_weights, bucket_id, False)
+
+            tokens, start_time = 0.0, time.time()
+            for _, encoder_inputs, target_weights, bucket_id in batches:
+                model.step(session, encoder_inputs, target_weights, bucket_id, False)
+                tokens += np.sum(target_weights)
+            elapsed = time.time() - start_time
+
+        print("rnn %s encoder: %d steps, %.0f tokens/sec" % (mode, len(batches), tokens / elapsed))
+
+
+BENCHMARKS = {
+    'decoder_modes': decoder_modes,
+    'encoder_caps': encoder_caps,
+    'encoder_engines': encoder_engines,
+    'encoder_modes': encoder_modes,
+    'rnn_modes': rnn_modes,
+    'config_startup': config_startup,
+    'update_modes': update_modes,
+    'word2vec': word2vec,
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
@@ -14,23 +14,26 @@ import tensorflow as tf
 from tensorflow.contrib.legacy_seq2seq import basic_rnn_seq2seq, sequence_loss_by_example, sequence_loss
 import data_utils as data_utils
 from data_utils import get_embedding_data, LogFileWriter
-from multiprocessing_generator import ParallelGenerator
+import batch_loader as batch_loader
+import input_pipeline as input_pipeline
+import dynamic_decoder as dynamic_decoder
+import rnn_cells as rnn_cells
+import dilated_conv as dilated_conv
+from memory_report import print_memory_report
 from tensorflow.python.ops import variable_scope
 # from sample_vocab import get_sampled_toy_set
-from nn_config import  TestConfigToy
+from nn_config import  TestConfigToy, embedding_initial_value
 from tqdm import *
 
 def data_type():
   return  tf.float32
 
-BASIC = "basic"
-CUDNN = "cudnn"
-BLOCK = "block"
+from rnn_cells import BASIC, CUDNN, BLOCK
 
 class DilatedCNN:
 
 
-    def __init__(self, config, forward_only, layers):
+    def __init__(self, config, forward_only, layers, inputs=None):
 
         self.config = config
         # with tf.device(self.config.gpu):
@@ -51,20 +54,39 @@ class DilatedCNN:
         # self.encoder_inputs.append([tf.nn.embedding_lookup(self.embeddings, np.full(self.config.batch_size, data_utils.GO_ID))])
         self.target_weights = []
         # self.encoder_inputs_positions = tf.placeholder(dtype=tf.int32, shape=[self.config.batch_size,  self.config.buckets[-1][0]])
-        self.encoder_inputs_positions = tf.placeholder(dtype=tf.int32, shape=[self.config.batch_size,  self.config.cap])
-        self.encoder_inputs = [tf.nn.embedding_lookup(self.embeddings, self.encoder_inputs_positions)]
-
-        for i, bucket in enumerate(self.config.buckets):
-            # for i in xrange(self.config.buckets[-1][0]):  # Last bucket is the biggest one.
-            targets_j = []
-            target_weights_j = []
-            for j in xrange(bucket[0]):  # Last bucket is the biggest one.
-                targets_j.append(tf.placeholder(tf.int32, shape=[None],
-                                                          name="targets{0}_{0}".format(i,j)))
-                target_weights_j.append(tf.placeholder(self.config.dtype, shape=[None],
-                                                          name="weight{0}_{0}".format(i)))
-            self.targets.append(targets_j)
-            self.target_weights.append(target_weights_j)
+
+        # One [batch_size, bucket length] matrix of targets and weights per bucket,
+        # unstacked into the per-timestep vectors the legacy seq2seq functions expect.
+        self.target_matrices = []
+        self.weight_matrices = []
+        dynamic = self.config.decoder_mode == 'dynamic'
+        # With update_mode 'shared' training runs the decoder of the bucket fed to bucket_id,
+        # so all buckets share one backward pass and update.
+        shared = self.config.update_mode == 'shared' and not dynamic and not forward_only
+        self.bucket_id = tf.placeholder(tf.int32, shape=[], name="bucket_id") if shared else None
+
+        if shared and (inputs is not None or self.config.bucket_caps):
+            raise ValueError("update_mode 'shared' needs input_mode 'feed' and no bucket_caps")
+
+        if dynamic or shared:
+            if inputs is not None:
+                raise ValueError("decoder_mode 'dynamic' needs input_mode 'feed'")
+            # A single [batch_size, length] pair of placeholders serves all buckets.
+            self.target_matrices = [tf.placeholder(tf.int32, shape=[None, None], name="targets")] * len(self.config.buckets)
+            self.weight_matrices = [tf.placeholder(self.config.dtype, shape=[None, None], name="weights")] * len(self.config.buckets)
+        else:
+            for i, bucket in enumerate(self.config.buckets):
+                if inputs is not None:
+                    # In dataset mode the targets come straight from the bucket's iterator.
+                    target_matrix = inputs.inputs[i]['targets']
+                    weight_matrix = inputs.inputs[i]['weights']
+                else:
+                    target_matrix = tf.placeholder(tf.int32, shape=[None, bucket[0]], name="targets{0}".format(i))
+                    weight_matrix = tf.placeholder(self.config.dtype, shape=[None, bucket[0]], name="weights{0}".format(i))
+                self.target_matrices.append(target_matrix)
+                self.weight_matrices.append(weight_matrix)
+                self.targets.append(tf.unstack(target_matrix, axis=1))
+                self.target_weights.append(tf.unstack(weight_matrix, axis=1))
 
         with tf.device(self.config.cpu):
 
@@ -78,59 +100,29 @@ class DilatedCNN:
                         decoder_inputs_j.append(emb_look)
                 self.decoder_inputs.append(decoder_inputs_j)
 
-        # self.filter_ =  tf.get_variable("conv_filter",shape=[1, 3, 1, 1000])
-
-        initial_nr_filter = self.config.hidden_size * self.config.num_layers
-        dimension = 3
-
-        initial_shape = [1, dimension, self.config.embedding_dim, initial_nr_filter]
-
-        self.first_w = tf.get_variable("first_w", shape=initial_shape, initializer=tf.contrib.layers.xavier_initializer())
-        # self.conv_w = tf_utils.initialize_weights(filter_shape, layer_name + "_w", init_type=initialization,
-        #                                 gain=self.nonlinearity, divisor=self.num_classes)
-        self.conv0 = tf.nn.conv2d(self.encoder_inputs, self.first_w, strides=[1, 1, 1, 1],
-                                            padding='VALID')
-        # self.conv = tf.nn.atrous_conv2d(self.encoder_inputs, self.filter_, strides=[1, 1, 1, 1],
-        #                                     padding='SAME')
-
+        if self.config.bucket_caps and dynamic:
+            raise ValueError("bucket_caps needs decoder_mode 'bucketed'")
 
-        def r(l):
-            return 2 ** (l + 1)
-
-        self.first_b = tf.get_variable( "first_b", initializer=tf.constant(0.01, shape=[initial_nr_filter]))
-
-        self.first_output = tf.nn.dropout(tf.nn.relu(tf.nn.bias_add(self.conv0, self.first_b), name="relu"), keep_prob=self.config.keep_prob)
-
-
-        if self.config.static:
-            self.dilated_weight = tf.get_variable("dilated_weight", shape=[1, dimension, initial_nr_filter, initial_nr_filter], initializer=tf.contrib.layers.xavier_initializer())
-            self.dilated_biase = tf.get_variable( "dilated_biase", initializer=tf.constant(0.01, shape=[initial_nr_filter]))
-            self.dilated_convs = []
-            self.encoder_outputs = []
-            self.encoder_outputs.append(self.first_output)
-
-            for layer in xrange(0, layers):
-                dilation = r(layer)
-                # dilation = 1
-                # self.dilated_weights.append(tf.get_variable("dilated_weights_" + str(layer), shape=[1, dimension, initial_nr_filter, initial_nr_filter], initializer=tf.contrib.layers.xavier_initializer()))
-                self.dilated_convs.append(tf.nn.atrous_conv2d(self.encoder_outputs[-1], self.dilated_weight, rate=dilation, padding="VALID", name='dilated_conv_'+ str(layer)))
-                # self.dilated_biases.append(tf.get_variable( "dilated_biases_"+ str(layer), initializer=tf.constant(0.01, shape=[initial_nr_filter])))
-                self.encoder_outputs.append(tf.nn.dropout(tf.nn.relu(tf.nn.bias_add(self.dilated_convs[-1], self.dilated_biase), name="dilated_outputs_"+ str(layer)), keep_prob=self.config.keep_prob))
+        if inputs is None and not self.config.bucket_caps:
+            self.encoder_inputs_positions = tf.placeholder(dtype=tf.int32, shape=[self.config.batch_size,  self.config.cap])
+            self.bucket_encoder_inputs = [self.encoder_inputs_positions] * len(self.config.buckets)
+            encoder_outputs = [self.dilated_encoder(self.encoder_inputs_positions, layers)] * len(self.config.buckets)
         else:
-            self.dilated_weights = []
-            self.dilated_convs = []
-            self.dilated_biases = []
-            self.encoder_outputs = []
-            self.encoder_outputs.append(self.first_output)
-
-            for layer in xrange(0, layers):
-                dilation = r(layer)
-                # dilation = 1
-                self.dilated_weights.append(tf.get_variable("dilated_weights_" + str(layer), shape=[1, dimension, initial_nr_filter, initial_nr_filter], initializer=tf.contrib.layers.xavier_initializer()))
-                self.dilated_convs.append(tf.nn.atrous_conv2d(self.encoder_outputs[-1], self.dilated_weights[-1], rate=dilation, padding="VALID", name='dilated_conv_'+ str(layer)))
-                self.dilated_biases.append(tf.get_variable( "dilated_biases_"+ str(layer), initializer=tf.constant(0.01, shape=[initial_nr_filter])))
-                self.encoder_outputs.append(tf.nn.dropout(tf.nn.relu(tf.nn.bias_add(self.dilated_convs[-1], self.dilated_biases[-1]), name="dilated_outputs_"+ str(layer)), keep_prob=self.config.keep_prob))
-
+            # Every bucket has its own encoder input, the encoders share their variables.
+            if inputs is None:
+                self.bucket_encoder_inputs = [
+                    tf.placeholder(dtype=tf.int32, shape=[self.config.batch_size, cap], name="encoder{0}".format(j))
+                    for j, cap in enumerate(bucket_caps(self.config))]
+            else:
+                self.bucket_encoder_inputs = [bucket_inputs['encoder'] for bucket_inputs in inputs.inputs]
+            # The longest bucket has the most layers and creates all variables.
+            encoder_outputs = [None] * len(self.config.buckets)
+            for j in reversed(xrange(len(self.config.buckets))):
+                encoder_input = self.bucket_encoder_inputs[j]
+                with variable_scope.variable_scope(
+                        variable_scope.get_variable_scope(), reuse=True if j < len(self.config.buckets) - 1 else None):
+                    encoder_outputs[j] = self.dilated_encoder(
+                        encoder_input, len(encoder_plan(self.config, encoder_input.shape[1].value)[0]))
 
         softmax_loss_function = None
 
@@ -187,7 +179,7 @@ class DilatedCNN:
 
         # Create the internal multi-layer cell for our RNN.
         def single_cell():
-            return tf.contrib.rnn.BasicLSTMCell(self.config.hidden_size)
+            return rnn_cells.lstm_cell(self.config.rnn_mode, self.config.hidden_size)
         cell = single_cell()
 
         zero_state = cell.zero_state(config.batch_size, tf.float32)
@@ -208,10 +200,10 @@ class DilatedCNN:
         #     for idx in range(self.config.num_layers)]
         # )
 
-        self.initial_states = tuple(
-            [tf.contrib.rnn.LSTMStateTuple(state_per_layer_list[idx], tf.reshape(tf.squeeze(self.encoder_outputs[-1]), [self.config.batch_size, self.config.num_layers, -1])[:,idx,:])
+        self.initial_states = [tuple(
+            [tf.contrib.rnn.LSTMStateTuple(state_per_layer_list[idx], tf.reshape(tf.squeeze(encoder_output), [self.config.batch_size, self.config.num_layers, -1])[:,idx,:])
             for idx in range(self.config.num_layers)]
-        )
+        ) for encoder_output in encoder_outputs]
 
 
 
@@ -232,15 +224,44 @@ class DilatedCNN:
             cell = tf.contrib.rnn.MultiRNNCell([single_cell() for _ in range(self.config.num_layers)])
 
         def seq_decoder(initial_state, decoder_inputs, do_decode):
-            return tf.contrib.legacy_seq2seq.rnn_decoder(
-                decoder_inputs,
-                initial_state,
-                cell,
-                loop_function = _extract_argmax_and_embed(self.embeddings, do_decode, output_projection=output_projection),
-                # data_type = self.config.dtype
-            )
-
-        if forward_only:
+            with rnn_cells.forget_bias_scope():
+                return tf.contrib.legacy_seq2seq.rnn_decoder(
+                    decoder_inputs,
+                    initial_state,
+                    cell,
+                    loop_function = _extract_argmax_and_embed(self.embeddings, do_decode, output_projection=output_projection),
+                    # data_type = self.config.dtype
+                )
+
+        if dynamic:
+            with rnn_cells.forget_bias_scope():
+                outputs = dynamic_decoder.dynamic_decoder(cell, self.initial_states[0], self.embeddings,
+                                                          self.target_matrices[0], self.weight_matrices[0],
+                                                          output_projection,
+                                                          feed_previous=forward_only or self.config.teacher_forcing)
+            loss = dynamic_decoder.sequence_loss(outputs, self.target_matrices[0], self.weight_matrices[0],
+                                                 output_projection, softmax_loss_function)
+            if forward_only:
+                outputs = dynamic_decoder.project(outputs, output_projection)
+            self.outputs = [outputs] * len(self.config.buckets)
+            self.losses = [loss] * len(self.config.buckets)
+
+        elif shared:
+            def bucket_loss(j):
+                length = self.config.buckets[j][0]
+                targets = tf.unstack(tf.reshape(self.target_matrices[j], [-1, length]), axis=1)
+                weights = tf.unstack(tf.reshape(self.weight_matrices[j], [-1, length]), axis=1)
+                decoder_inputs = [tf.nn.embedding_lookup(self.embeddings, np.full(self.config.batch_size, data_utils.GO_ID))]
+                decoder_inputs += [tf.nn.embedding_lookup(self.embeddings, target) for target in targets[:-1]]
+                outputs, _ = seq_decoder(self.initial_states[j], decoder_inputs, self.config.teacher_forcing)
+                return sequence_loss(outputs, targets, weights, softmax_loss_function=softmax_loss_function)
+
+            # No outputs, as the buckets' output lists differ in length; step only fetches the loss.
+            self.outputs = [None] * len(self.config.buckets)
+            self.losses = [dynamic_decoder.select_bucket(self.bucket_id, len(self.config.buckets), bucket_loss)] * \
+                len(self.config.buckets)
+
+        elif forward_only:
             # self.outputs, self.losses = tf.contrib.legacy_seq2seq.model_with_buckets(
             self.outputs, self.losses = self.decoder_with_buckets(self.initial_states,
                  self.decoder_inputs, self.targets,
@@ -270,16 +291,100 @@ class DilatedCNN:
             self.updates = []
             # opt = tf.train.GradientDescentOptimizer(self.learning_rate)
             opt = tf.train.AdamOptimizer() #self.learning_rate)
+            self.optimizer = opt
             # opt = tf.train.AdagradOptimizer(self.learning_rate, )
-            for b in xrange(len(self.config.buckets)):
-                gradients = tf.gradients(self.losses[b], params)
-                clipped_gradients, norm = tf.clip_by_global_norm(gradients,
-                                                                 self.config.max_gradient_norm)
-                self.gradient_norms.append(norm)
-                self.updates.append(opt.apply_gradients(
-                    zip(clipped_gradients, params), global_step=self.global_step))
+            if dynamic or shared:
+                update, norm = dynamic_decoder.clipped_update(opt, self.losses[0], params,
+                                                              self.config.max_gradient_norm, self.global_step)
+                self.updates = [update] * len(self.config.buckets)
+                self.gradient_norms = [norm] * len(self.config.buckets)
+            else:
+                for b in xrange(len(self.config.buckets)):
+                    gradients = tf.gradients(self.losses[b], params)
+                    clipped_gradients, norm = tf.clip_by_global_norm(gradients,
+                                                                     self.config.max_gradient_norm)
+                    self.gradient_norms.append(norm)
+                    self.updates.append(opt.apply_gradients(
+                        zip(clipped_gradients, params), global_step=self.global_step))
+
+        # The frozen embeddings are re-initialized from config.embeddings_np after a restore,
+        # the LSTM weights are saved under names every rnn_mode can restore.
+        self.saved_variables = [variable for variable in tf.global_variables() if variable is not self.embeddings]
+        self.saver = tf.train.Saver(rnn_cells.saver_variables(self.saved_variables))
+
+    def dilated_encoder(self, encoder_inputs_positions, layers):
+        """Builds the dilated CNN encoder over a [batch_size, cap] matrix of token ids.
+
+        Returns:
+          The output of the last dilated layer, which holds the initial cell states
+          of all decoder layers.
+        """
+        if self.config.encoder_engine == 'conv1d':
+            # [batch_size, cap, embedding_dim] without the conv2d height axis; the
+            # dilations are planned for the exact input length.
+            self.encoder_inputs = tf.nn.embedding_lookup(self.embeddings, encoder_inputs_positions)
+            dilations, _ = dilated_conv.exact_plan(encoder_inputs_positions.shape[1].value or self.config.cap)
+            self.encoder_outputs = [dilated_conv.conv1d_encoder(
+                self.encoder_inputs, dilations, self.config.hidden_size * self.config.num_layers,
+                self.config.keep_prob, self.config.static)]
+            return self.encoder_outputs[-1]
+
+        self.encoder_inputs = [tf.nn.embedding_lookup(self.embeddings, encoder_inputs_positions)]
+
+        # self.filter_ =  tf.get_variable("conv_filter",shape=[1, 3, 1, 1000])
+
+        initial_nr_filter = self.config.hidden_size * self.config.num_layers
+        dimension = 3
+
+        initial_shape = [1, dimension, self.config.embedding_dim, initial_nr_filter]
+
+        self.first_w = tf.get_variable("first_w", shape=initial_shape, initializer=tf.contrib.layers.xavier_initializer())
+        # self.conv_w = tf_utils.initialize_weights(filter_shape, layer_name + "_w", init_type=initialization,
+        #                                 gain=self.nonlinearity, divisor=self.num_classes)
+        self.conv0 = tf.nn.conv2d(self.encoder_inputs, self.first_w, strides=[1, 1, 1, 1],
+                                            padding='VALID')
+        # self.conv = tf.nn.atrous_conv2d(self.encoder_inputs, self.filter_, strides=[1, 1, 1, 1],
+        #                                     padding='SAME')
+
+
+        def r(l):
+            return 2 ** (l + 1)
+
+        self.first_b = tf.get_variable( "first_b", initializer=tf.constant(0.01, shape=[initial_nr_filter]))
+
+        self.first_output = tf.nn.dropout(tf.nn.relu(tf.nn.bias_add(self.conv0, self.first_b), name="relu"), keep_prob=self.config.keep_prob)
+
+
+        if self.config.static:
+            self.dilated_weight = tf.get_variable("dilated_weight", shape=[1, dimension, initial_nr_filter, initial_nr_filter], initializer=tf.contrib.layers.xavier_initializer())
+            self.dilated_biase = tf.get_variable( "dilated_biase", initializer=tf.constant(0.01, shape=[initial_nr_filter]))
+            self.dilated_convs = []
+            self.encoder_outputs = []
+            self.encoder_outputs.append(self.first_output)
+
+            for layer in xrange(0, layers):
+                dilation = r(layer)
+                # dilation = 1
+                # self.dilated_weights.append(tf.get_variable("dilated_weights_" + str(layer), shape=[1, dimension, initial_nr_filter, initial_nr_filter], initializer=tf.contrib.layers.xavier_initializer()))
+                self.dilated_convs.append(tf.nn.atrous_conv2d(self.encoder_outputs[-1], self.dilated_weight, rate=dilation, padding="VALID", name='dilated_conv_'+ str(layer)))
+                # self.dilated_biases.append(tf.get_variable( "dilated_biases_"+ str(layer), initializer=tf.constant(0.01, shape=[initial_nr_filter])))
+                self.encoder_outputs.append(tf.nn.dropout(tf.nn.relu(tf.nn.bias_add(self.dilated_convs[-1], self.dilated_biase), name="dilated_outputs_"+ str(layer)), keep_prob=self.config.keep_prob))
+        else:
+            self.dilated_weights = []
+            self.dilated_convs = []
+            self.dilated_biases = []
+            self.encoder_outputs = []
+            self.encoder_outputs.append(self.first_output)
 
-        self.saver = tf.train.Saver(tf.global_variables())
+            for layer in xrange(0, layers):
+                dilation = r(layer)
+                # dilation = 1
+                self.dilated_weights.append(tf.get_variable("dilated_weights_" + str(layer), shape=[1, dimension, initial_nr_filter, initial_nr_filter], initializer=tf.contrib.layers.xavier_initializer()))
+                self.dilated_convs.append(tf.nn.atrous_conv2d(self.encoder_outputs[-1], self.dilated_weights[-1], rate=dilation, padding="VALID", name='dilated_conv_'+ str(layer)))
+                self.dilated_biases.append(tf.get_variable( "dilated_biases_"+ str(layer), initializer=tf.constant(0.01, shape=[initial_nr_filter])))
+                self.encoder_outputs.append(tf.nn.dropout(tf.nn.relu(tf.nn.bias_add(self.dilated_convs[-1], self.dilated_biases[-1]), name="dilated_outputs_"+ str(layer)), keep_prob=self.config.keep_prob))
+
+        return self.encoder_outputs[-1]
 
     def build_embedding_tensor(self):
         # with tf.device(self.cpu):
@@ -287,13 +392,9 @@ class DilatedCNN:
             # self.embeddings = tf.Variable(tf.constant(0.0, shape=[self.config.vocab_size, self.config.embedding_dim]),
             #                 trainable=False, name="W")
             with tf.name_scope('embedding'):
-                self.embeddings = tf.get_variable(name="Embeddings",
-                                                  shape=[self.config.vocab_size, self.config.embedding_dim],
-                                                  dtype=data_type(), initializer=self.const_initializer,
+                self.embeddings = tf.get_variable(name="Embeddings", dtype=data_type(),
+                                                  initializer=embedding_initial_value(self.config.embeddings_np),
                                                   trainable=False)
-                self.embedding_placeholder = tf.placeholder(data_type(),
-                                                            [self.config.vocab_size, self.config.embedding_dim])
-                self.embedding_init = self.embeddings.assign(self.embedding_placeholder)
 
 
     def initializers(self):
@@ -317,7 +418,7 @@ class DilatedCNN:
         e.g., seq2seq = lambda x, y: basic_rnn_seq2seq(
             x, y, rnn_cell.GRUCell(24))
         Args:
-          encoder_inputs: A list of Tensors to feed the encoder; first seq2seq input.
+          initial_states: A list with the initial decoder state of each bucket.
           decoder_inputs: A list of Tensors to feed the decoder; second seq2seq input.
           targets: A list of 1D batch-sized int32 Tensors (desired output sequence).
           weights: List of 1D batch-sized float-Tensors to weight the targets.
@@ -363,7 +464,7 @@ class DilatedCNN:
             for j, bucket in enumerate(buckets):
                 with variable_scope.variable_scope(
                         variable_scope.get_variable_scope(),  reuse=True if j > 0 else None):
-                    bucket_outputs, _ = decoder(initial_states,
+                    bucket_outputs, _ = decoder(initial_states[j],
                                                 decoder_inputs[j])
                     outputs.append(bucket_outputs)
                     if per_example_loss:
@@ -392,9 +493,10 @@ class DilatedCNN:
 
         Args:
           session: tensorflow session to use.
-          encoder_inputs: list of numpy int vectors to feed as encoder inputs.
-          decoder_inputs: list of numpy int vectors to feed as decoder inputs.
-          target_weights: list of numpy float vectors to feed as target weights.
+          encoder_inputs: time-major [length, batch_size] int array to feed as
+            encoder inputs, or None if the model reads its inputs from a DatasetInputs.
+          decoder_inputs: time-major int array to feed as decoder inputs.
+          target_weights: time-major float array to feed as target weights.
           bucket_id: which bucket of the model to use.
           forward_only: whether to do the backward step or only forward.
 
@@ -421,13 +523,14 @@ class DilatedCNN:
         #                      " %d != %d." % (len(target_weights), decoder_size))
 
         # Input feed: encoder inputs, decoder inputs, target_weights, as provided.
+        # In dataset mode they are None, as the graph reads them from its iterators.
         input_feed = {}
-        input_feed[self.encoder_inputs_positions] = np.array(encoder_inputs).T
-        # for l in xrange(encoder_size):
-        for l in xrange(decoder_size):
-            input_feed[self.targets[bucket_id][l].name] = decoder_inputs[l]
-            # input_feed[self.decoder_inputs[l].name] = decoder_inputs[l]
-            input_feed[self.target_weights[bucket_id][l].name] = target_weights[l]
+        if encoder_inputs is not None:
+            input_feed[self.bucket_encoder_inputs[bucket_id]] = np.asarray(encoder_inputs).T
+            if self.bucket_id is not None:
+                input_feed[self.bucket_id] = bucket_id
+            input_feed[self.target_matrices[bucket_id]] = np.asarray(decoder_inputs).T
+            input_feed[self.weight_matrices[bucket_id]] = np.asarray(target_weights).T
 
 
 
@@ -445,84 +548,55 @@ class DilatedCNN:
                            self.losses[bucket_id]]  # Loss for this batch.
         else:
             output_feed = [self.losses[bucket_id]]  # Loss for this batch.
-            for l in xrange(decoder_size):  # Output logits.
-                output_feed.append(self.outputs[bucket_id][l])
+            if self.outputs[bucket_id] is None:
+                pass  # The shared training graph only has the loss.
+            elif self.config.decoder_mode == 'dynamic':
+                output_feed.append(self.outputs[bucket_id])  # [batch_size, length, vocab_size] logits.
+            else:
+                for l in xrange(decoder_size):  # Output logits.
+                    output_feed.append(self.outputs[bucket_id][l])
 
         outputs = session.run(output_feed, input_feed)
         if not forward_only:
             return outputs[1], outputs[2], None  # Gradient norm, loss, no outputs.
+        elif self.outputs[bucket_id] is None:
+            return None, outputs[0], None  # No gradient norm, loss, no outputs.
+        elif self.config.decoder_mode == 'dynamic':
+            return None, outputs[0], list(np.swapaxes(outputs[1], 0, 1))  # No gradient norm, loss, outputs.
         else:
             return None, outputs[0], outputs[1:]  # No gradient norm, loss, outputs.
 
     def get_batch(self, data, cap):
-        """Get a random batch of data from the specified bucket, prepare for step.
+        """Pad a batch of documents, prepare for step.
 
-        To feed data in step(..) it must be a list of batch-major vectors, while
-        data here contains single length-major cases. So the main logic of this
-        function is to re-index data cases to be in the proper format for feeding.
+        To feed data in step(..) it must be time-major, while data here contains
+        single length-major cases. The padding and re-indexing is done by
+        data_utils.pad_batch in one vectorized pass.
 
         Args:
-          data: a tuple of size len(self.buckets) in which each element contains
-            lists of pairs of input and output data that we use to create a batch.
-          bucket_id: integer, which bucket to get the batch for.
+          data: list of at most batch_size token id documents.
+          cap: integer, number of time steps to pad the documents to.
 
         Returns:
-          The triple (encoder_inputs, decoder_inputs, target_weights) for
-          the constructed batch that has the proper format to call step(...) later.
+          The pair (inputs, weights) of [length, batch_size] arrays that has the
+          proper format to call step(...) later.
         """
-        # encoder_size, decoder_size = self.config.buckets[bucket_id]
-        encoder_size = cap
-        encoder_inputs = []
-
-        # Get a random batch of encoder and decoder inputs from data,
-        # pad them if needed, reverse encoder inputs and add GO to decoder.
-        for d in data:
-            # Encoder inputs are padded and then reversed.
-            encoder_pad = [data_utils.PAD_ID] * (encoder_size - len(d))
-            encoder_inputs.append(list(d + encoder_pad))
-
-        while len(encoder_inputs) < self.config.batch_size:
-            encoder_inputs.append([data_utils.PAD_ID] * encoder_size)
-
-        # Now we create batch-major vectors from the data selected above.
-        batch_encoder_inputs, batch_weights = [], []
+        return data_utils.pad_batch(data, cap, self.config.batch_size)
 
-        # Batch encoder inputs are just re-indexed encoder_inputs.
-        for length_idx in xrange(encoder_size):
-            try:
-                batch_encoder_inputs.append(
-                    np.array([encoder_inputs[batch_idx][length_idx]
-                              for batch_idx in xrange(self.config.batch_size)], dtype=np.int32))
-            except:
-                pass
 
-            batch_weight = np.ones(self.config.batch_size, dtype=np.float32)
-            for batch_idx in xrange(self.config.batch_size):
-                # We set weight to 0 if the corresponding target is a PAD symbol.
-                # The corresponding target is decoder_input shifted by 1 forward.
-                if encoder_inputs[batch_idx][length_idx] == data_utils.PAD_ID:
-                    batch_weight[batch_idx] = 0.0
-            batch_weights.append(batch_weight)
-        # batch_weights.append(np.zeros(self.config.batch_size, dtype=np.float32))
 
-        if np.array(batch_encoder_inputs).size != np.array(batch_weights).size:
-            pass
 
-        return batch_encoder_inputs, batch_weights
-
-
-
-
-def create_model(session, config, forward_only, layers):
+def create_model(session, config, forward_only, layers, inputs=None):
     """Create translation model and initialize or load parameters in session."""
 
     # dtype = tf.float16 if FLAGS.use_fp16 else tf.float32
-    model = DilatedCNN(config, forward_only, layers)
+    model = DilatedCNN(config, forward_only, layers, inputs)
     ckpt = tf.train.get_checkpoint_state(config.train_dir)
     # print (ckpt.model_checkpoint_path)
-    if ckpt and tf.train.checkpoint_exists(ckpt.model_checkpoint_path):
-        print("Reading model parameters from %s" % ckpt.model_checkpoint_path)
-        model.saver.restore(session, ckpt.model_checkpoint_path)
+    if ckpt and tf.train.checkpoint_exists(ckpt.model_checkpoint_path) and \
+            rnn_cells.restore(session, model.saved_variables, ckpt.model_checkpoint_path):
+        print("Read model parameters from %s" % ckpt.model_checkpoint_path)
+        session.run(model.embeddings.initializer)
     else:
         print("Created model with fresh parameters.")
         session.run(tf.global_variables_initializer())
@@ -531,16 +605,23 @@ def create_model(session, config, forward_only, layers):
     writer = tf.summary.FileWriter('dil_CNN', session.graph)
     return model
 
+def encoder_plan(config, tokens):
+    """Dilations and input length of the encoder engine of config covering tokens."""
+    plan = dilated_conv.exact_plan if config.encoder_engine == 'conv1d' else dilated_conv.doubling_plan
+    return plan(tokens)
+
+
 def needed_layers(config):
-    tokens = config.buckets[-1][0]
-    def tokens_captured(l):
-        return 2 ** (l + 1) - 1
-    layer = 1
-    while True:
-        cap = tokens_captured(layer)
-        if cap >= tokens:
-            return layer - 1 , cap
-        layer += 1
+    """Number of dilated layers and encoder input length covering the largest bucket."""
+    dilations, cap = encoder_plan(config, config.buckets[-1][0])
+    return len(dilations), cap
+
+
+def bucket_caps(config):
+    """Encoder input length of every bucket, sized to the bucket with config.bucket_caps."""
+    if not config.bucket_caps:
+        return [needed_layers(config)[1]] * len(config.buckets)
+    return [encoder_plan(config, bucket[0])[1] for bucket in config.buckets]
 
 def train(config, forward_only, train_log_file, test_log_file):
     """Train a en->fr translation model using WMT data."""
@@ -552,14 +633,14 @@ def train(config, forward_only, train_log_file, test_log_file):
     # config.gpu_options.per_process_gpu_memory_fraction = 0.99
     sess_config.gpu_options.allow_growth = True
 
-    with tf.Session(config=sess_config) as sess:
-        # with tf.Session() as sess:
-        # Create model.
-        print("Creating %d layers of %d units." % (config.num_layers, config.hidden_size))
+    sess = tf.Session(config=sess_config)
+    # with tf.Session() as sess:
+    # Create model.
+    print("Creating %d layers of %d units." % (config.num_layers, config.hidden_size))
 
-        vocab_size = config.vocab_size
-        print('getting embeddings')
-        # embeddings_mentions, embeddings, embeddings_mentions_list = data_utils.get_embedding_data(location, vocab_size)
+    vocab_size = config.vocab_size
+    print('getting embeddings')
+    # embeddings_mentions, embeddings, embeddings_mentions_list = data_utils.get_embedding_data(location, vocab_size)
 
     # train_set, test_set = doc_bucket_seperator(mongodb_name, _buckets, embeddings_mentions, train_test_perc=0.80,
     #                                            nr_docs=100)
@@ -574,11 +655,15 @@ def train(config, forward_only, train_log_file, test_log_file):
     config.cap = cap
     # checkpoint_counter = 0.0
 
+    caps = bucket_caps(config)
+    inputs = input_pipeline.dataset_inputs(config, caps)
+
     print('building model')
-    model = create_model(sess,config, forward_only, layers)
+    model = create_model(sess,config, forward_only, layers, inputs)
 
 
-    sess.run(model.embedding_init, {model.embedding_placeholder: model.config.embeddings_np})
+    print_memory_report(config, model)
+    dilated_conv.print_encoder_report(config, config.embedding_dim)
 
     # train_set, dev_set = data_utils.bucket_generator(mongodb_name, config.buckets, max_len, embeddings_mentions, train_length,
     #                                                  test_length)
@@ -593,6 +678,7 @@ def train(config, forward_only, train_log_file, test_log_file):
 
     # This is the training loop.
     step_time, single_step_time, loss, single_step_loss = 0.0, 0.0, 0.0, 0.0
+    tokens = 0.0
     current_step = 0
     previous_losses = []
 
@@ -602,119 +688,118 @@ def train(config, forward_only, train_log_file, test_log_file):
         test_log_file.append_text('Epoch: ' + str(epoch))
 
         # generator = new_bucket_generator(mongodb_name, config.buckets, train_set, embeddings_mentions, 4)
-        generator = config.generator(*config.train_args)
-
         # while True:
             # Choose a bucket according to data distribution. We pick a random number
             # in [0, 1] and use the corresponding interval in train_buckets_scale.
 
             # batch, bucket_id = generator.next()
 
-        with ParallelGenerator(generator, max_lookahead=10) as batch_gen_lookahead:
-            for batch, bucket_id in batch_gen_lookahead:
-
-                if batch is None: break
-
-                # Get a batch and make a step.
-                start_time = time.time()
-
-                # encoder_inputs,  target_weights = model.get_batch(batch, cap)
-
-                encoder_inputs, _ = model.get_batch(batch, cap)
-                decoder_inputs, target_weights = model.get_batch(batch, config.buckets[bucket_id][0])
-
-                _, step_loss, _ = model.step(sess, encoder_inputs,decoder_inputs, target_weights, bucket_id, False)
-                step_time += (time.time() - start_time) / config.steps_per_checkpoint
-                # single_step_time += (time.time() - start_time) / (config.steps_per_checkpoint / 100)
-                loss += (step_loss / config.steps_per_checkpoint)
-                # checkpoint_counter += 1
-                # single_step_loss += step_loss / (config.steps_per_checkpoint / 100)
-                current_step += 1
-
-
-                # Once in a while, we save checkpoint, print statistics, and run evals.
-                #
-                # if current_step % config.steps_per_checkpoint == 0:
-                #     perplexity = math.exp(float(loss)) if loss < 300 else float("inf")
-                #     print("global step %d learning rate %.4f step-time %.2f perplexity "
-                #           "%.2f" % (model.global_step.eval(session=sess), model.learning_rate.eval(session=sess),
-                #                     step_time, perplexity))
-                #     # Decrease learning rate if no improvement was seen over last 3 times.
-                #     if len(previous_losses) > 2 and loss > max(previous_losses[-3:]):
-                #         sess.run(model.learning_rate_decay_op)
-                #     previous_losses.append(loss)
-                #     # Save checkpoint and zero timer and loss.
-                #     checkpoint_path = os.path.join(config.train_dir, "translate.ckpt")
-                #     model.saver.save(sess, checkpoint_path, global_step=model.global_step)
-                #     # Run evals on development set and print their perplexity.
-                #
-                #
-                #
-                # if current_step % (config.steps_per_checkpoint / 100) == 0:
-                #     # Print statistics for the previous epoch.
-                #     perplexity = math.exp(float(single_step_loss)) if single_step_loss < 300 else float("inf")
-                #     print("global step %d learning rate %.4f step-time %.2f perplexity "
-                #           "%.2f" % (model.global_step.eval(session=sess), model.learning_rate.eval(session=sess),
-                #                     single_step_time, perplexity))
-                #     single_step_time, single_step_loss = 0.0, 0.0
-
-
-                if current_step % config.steps_per_checkpoint == 0:
-                    # loss = loss / checkpoint_counter
-                    perplexity = math.exp(float(loss)) if loss < 300 else float("inf")
-                    print("global step %d learning rate %.4f step-time %.2f perplexity "
-                          "%.2f" % (model.global_step.eval(session=sess), model.learning_rate.eval(session=sess),
-                                    step_time, perplexity))
-                    # Decrease learning rate if no improvement was seen over last 3 times.
-                    # if len(previous_losses) > 2 and loss > max(previous_losses[-3:]):
-                    #     sess.run(model.learning_rate_decay_op)
-                    # previous_losses.append(loss)
-                    train_log_file.append_text(str(model.global_step.eval(session=sess)) + ';' + str(perplexity) + ';' + str(loss) + ';' + str(model.learning_rate.eval(session=sess)) + ';' + str(step_time))
-                    step_time, loss = 0.0, 0.0
-
-
-                    # Save checkpoint and zero timer and loss.
-                    # checkpoint_path = os.path.join(config.train_dir, "translate.ckpt")
-                    # model.saver.save(sess, checkpoint_path, global_step=model.global_step)
-                    # Run evals on development set and print their perplexity.
-
-
-
-                # if current_step % (config.steps_per_checkpoint / 100) == 0:
-                #     # Print statistics for the previous epoch.
-                #     perplexity = math.exp(float(single_step_loss)) if single_step_loss < 300 else float("inf")
-                #     print("global step %d learning rate %.4f step-time %.2f perplexity "
-                #           "%.2f" % (model.global_step.eval(session=sess), model.learning_rate.eval(session=sess),
-                #                     single_step_time, perplexity))
-                #
-                #     single_step_time, single_step_loss = 0.0, 0.0
+        if inputs is not None:
+            batches = input_pipeline.dataset_batches(inputs, sess, 'train')
+        else:
+            batches = batch_loader.batches(config, config.train_args, caps, epoch)
+
+        for encoder_inputs, decoder_inputs, target_weights, bucket_id in batches:
+
+            # Get a batch and make a step.
+            start_time = time.time()
+
+            _, step_loss, _ = model.step(sess, encoder_inputs,decoder_inputs, target_weights, bucket_id, False)
+            step_time += (time.time() - start_time) / config.steps_per_checkpoint
+            # Non-padding target tokens; in dataset mode the mask stays in the graph and
+            # the full bucket is counted.
+            tokens += np.sum(target_weights) if target_weights is not None else \
+                config.batch_size * config.buckets[bucket_id][0]
+            # single_step_time += (time.time() - start_time) / (config.steps_per_checkpoint / 100)
+            loss += (step_loss / config.steps_per_checkpoint)
+            # checkpoint_counter += 1
+            # single_step_loss += step_loss / (config.steps_per_checkpoint / 100)
+            current_step += 1
+
+
+            # Once in a while, we save checkpoint, print statistics, and run evals.
+            #
+            # if current_step % config.steps_per_checkpoint == 0:
+            #     perplexity = math.exp(float(loss)) if loss < 300 else float("inf")
+            #     print("global step %d learning rate %.4f step-time %.2f perplexity "
+            #           "%.2f" % (model.global_step.eval(session=sess), model.learning_rate.eval(session=sess),
+            #                     step_time, perplexity))
+            #     # Decrease learning rate if no improvement was seen over last 3 times.
+            #     if len(previous_losses) > 2 and loss > max(previous_losses[-3:]):
+            #         sess.run(model.learning_rate_decay_op)
+            #     previous_losses.append(loss)
+            #     # Save checkpoint and zero timer and loss.
+            #     checkpoint_path = os.path.join(config.train_dir, "translate.ckpt")
+            #     model.saver.save(sess, checkpoint_path, global_step=model.global_step)
+            #     # Run evals on development set and print their perplexity.
+            #
+            #
+            #
+            # if current_step % (config.steps_per_checkpoint / 100) == 0:
+            #     # Print statistics for the previous epoch.
+            #     perplexity = math.exp(float(single_step_loss)) if single_step_loss < 300 else float("inf")
+            #     print("global step %d learning rate %.4f step-time %.2f perplexity "
+            #           "%.2f" % (model.global_step.eval(session=sess), model.learning_rate.eval(session=sess),
+            #                     single_step_time, perplexity))
+            #     single_step_time, single_step_loss = 0.0, 0.0
+
+
+            if current_step % config.steps_per_checkpoint == 0:
+                # loss = loss / checkpoint_counter
+                perplexity = math.exp(float(loss)) if loss < 300 else float("inf")
+                print("global step %d learning rate %.4f step-time %.2f perplexity "
+                      "%.2f" % (model.global_step.eval(session=sess), model.learning_rate.eval(session=sess),
+                                step_time, perplexity))
+                # Decrease learning rate if no improvement was seen over last 3 times.
+                # if len(previous_losses) > 2 and loss > max(previous_losses[-3:]):
+                #     sess.run(model.learning_rate_decay_op)
+                # previous_losses.append(loss)
+                train_log_file.log(step=model.global_step.eval(session=sess), perplexity=perplexity, loss=loss,
+                                   learning_rate=model.learning_rate.eval(session=sess), step_time=step_time,
+                                   tokens_per_sec=tokens / (step_time * config.steps_per_checkpoint))
+                step_time, loss, tokens = 0.0, 0.0, 0.0
+
+
+                # Save checkpoint and zero timer and loss.
+                # checkpoint_path = os.path.join(config.train_dir, "translate.ckpt")
+                # model.saver.save(sess, checkpoint_path, global_step=model.global_step)
+                # Run evals on development set and print their perplexity.
+
+
+
+            # if current_step % (config.steps_per_checkpoint / 100) == 0:
+            #     # Print statistics for the previous epoch.
+            #     perplexity = math.exp(float(single_step_loss)) if single_step_loss < 300 else float("inf")
+            #     print("global step %d learning rate %.4f step-time %.2f perplexity "
+            #           "%.2f" % (model.global_step.eval(session=sess), model.learning_rate.eval(session=sess),
+            #                     single_step_time, perplexity))
+            #
+            #     single_step_time, single_step_loss = 0.0, 0.0
 
         checkpoint_path = os.path.join(config.train_dir, "translate.ckpt")
         model.saver.save(sess, checkpoint_path, global_step=model.global_step)
 
-        test_generator = config.generator(*config.test_args)
-
         print("Testing:")
-        with ParallelGenerator(test_generator, max_lookahead=10) as batch_gen_lookahead:
-            for batch, bucket_id in batch_gen_lookahead:
-                if batch == None: break
-
-                # encoder_inputs, target_weights = model.get_batch(batch, cap)
-
-
-                encoder_inputs, _ = model.get_batch(batch, cap)
-                decoder_inputs, target_weights = model.get_batch(batch, config.buckets[bucket_id][0])
+        if inputs is not None:
+            batches = input_pipeline.dataset_batches(inputs, sess, 'test')
+        else:
+            batches = batch_loader.batches(config, config.test_args, caps)
 
+        for encoder_inputs, decoder_inputs, target_weights, bucket_id in batches:
 
-                _, eval_loss, _ = model.step(sess, encoder_inputs, decoder_inputs, target_weights, bucket_id, True)
-                eval_ppx = math.exp(float(eval_loss)) if eval_loss < 300 else float(
-                    "inf")
-                print("  eval: bucket %d perplexity %.2f" % (bucket_id, eval_ppx))
+            _, eval_loss, _ = model.step(sess, encoder_inputs, decoder_inputs, target_weights, bucket_id, True)
+            eval_ppx = math.exp(float(eval_loss)) if eval_loss < 300 else float(
+                "inf")
+            print("  eval: bucket %d perplexity %.2f" % (bucket_id, eval_ppx))
 
-                test_log_file.append_text( str(bucket_id)  + ';' + str(eval_ppx) + ';' + str(eval_loss))
+            test_log_file.log(bucket=bucket_id, perplexity=eval_ppx, loss=eval_loss)
 
         # step_time, loss = 0.0, 0.0
         sys.stdout.flush()
+        train_log_file.flush()
+        test_log_file.flush()
+
+    sess.close()
 
 
 
@@ -747,7 +832,7 @@ def decode(config):
 
             # Get a 1-element batch to feed the sentence to the model.
             # encoder_inputs, target_weights = model.get_batch({bucket_id: [(token_ids, [])]}, bucket_id)
-            encoder_inputs, _ = model.get_batch([token_ids], cap)
+            encoder_inputs, _ = model.get_batch([token_ids], bucket_caps(config)[bucket_id])
             decoder_inputs, target_weights = model.get_batch([token_ids], config.buckets[bucket_id][0])
 
             # Get output logits for the sentence.
@@ -803,6 +888,8 @@ if __name__ == '__main__':
 
 
         train(train_config, False, train_log_file, test_log_file)
+        train_log_file.close()
+        test_log_file.close()
 
         tf.reset_default_graph()
 
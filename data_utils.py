@@ -1,8 +1,21 @@
 import numpy as np
 from tqdm import *
+import atexit
+import json
+import os
+import multiprocessing
 import random
 import re
-from preprocessing import pickle_call, pickle_dump
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from itertools import islice
+import preprocessing as preprocessing
+import six
+from six.moves import queue
+from six.moves import xrange  # pylint: disable=redefined-builtin
 
 _PAD = b"_PAD"
 _GO = b"_GO"
@@ -15,24 +28,88 @@ GO_ID = 1
 EOS_ID = 0
 UNK_ID = 3
 
+_PUNCTUATION = "!\"#$%&\\'()*+,\-./:;<=>?@[\]\^\`\{\|\}~\"'\xe2\x80\x99"
+_TOKEN_RE = re.compile("\s*([" + _PUNCTUATION + "]|[^" + _PUNCTUATION + "\s]*)\s*")
+
+
 def tokenize(text, lower= False, numbers=False):
-    punctuation = "!\"#$%&\\'()*+,\-./:;<=>?@[\]\^\`\{\|\}~\"'\xe2\x80\x99"
-    mentions = list(re.findall("\s*([" + punctuation + "]|[^" + punctuation + "\s]*)\s*", text))
+    if lower:
+        text = text.lower()
+    mentions = _TOKEN_RE.findall(text)
+
+    if numbers:
+        mentions = ['0' if mention.isdigit() else mention for mention in mentions]
+
+    return mentions
 
-    if lower or numbers:
-        new_mentions = []
-        for mention in mentions:
 
-            if lower:
-                mention = mention.lower()
+def _encode(texts, embeddings_mentions, lower, numbers, whitespace):
+    get = embeddings_mentions.get
+    tokens = array('i')
+    lengths = array('i')
+
+    for text in texts:
+        if whitespace:
+            mentions = (text.lower() if lower else text).split()
             if numbers:
-                if mention.isdigit():
-                    mention = '0'
-            new_mentions.append(mention)
+                mentions = ['0' if mention.isdigit() else mention for mention in mentions]
+        else:
+            mentions = tokenize(text, lower, numbers)
+        ids = [i for i in map(get, mentions) if i is not None]
+        tokens.extend(ids)
+        lengths.append(len(ids))
 
-        mentions = new_mentions
+    return tokens, lengths
 
-    return mentions
+
+_encoder_args = None
+
+
+def _init_encoder(*args):
+    global _encoder_args
+    _encoder_args = args
+
+
+def _encode_chunk(texts):
+    return _encode(texts, *_encoder_args)
+
+
+def encode_texts(texts, embeddings_mentions, lower=False, numbers=False, whitespace=False, processes=1,
+                 chunk_size=10000):
+    """Tokenizes a list of texts and maps them to vocabulary ids in one call.
+
+    Mentions missing from embeddings_mentions are dropped, like in sentence_to_token_ids.
+
+    Args:
+      texts: list of strings.
+      embeddings_mentions: dict from mention to id.
+      lower: lowercase the texts before looking them up.
+      numbers: replace all digit only mentions by '0'.
+      whitespace: split on whitespace, like the pre-tokenized corpus files, instead
+        of using tokenize.
+      processes: number of worker processes; chunks of chunk_size texts are encoded
+        in parallel when it is larger than 1.
+
+    Returns:
+      The pair (tokens, offsets) of a flat int32 id array and the int64 offsets of
+      the texts in it, as used by FlatCorpus.
+    """
+    if processes > 1 and len(texts) > chunk_size:
+        pool = multiprocessing.Pool(processes, initializer=_init_encoder,
+                                    initargs=(embeddings_mentions, lower, numbers, whitespace))
+        try:
+            chunks = pool.map(_encode_chunk, [texts[i:i + chunk_size] for i in xrange(0, len(texts), chunk_size)])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        chunks = [_encode(texts, embeddings_mentions, lower, numbers, whitespace)]
+
+    tokens = np.concatenate([np.frombuffer(chunk_tokens, dtype=np.int32) for chunk_tokens, _ in chunks])
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum(np.concatenate([np.frombuffer(chunk_lengths, dtype=np.int32) for _, chunk_lengths in chunks]),
+              out=offsets[1:])
+    return tokens, offsets
 
 
 def has_numbers(inputString):
@@ -47,230 +124,584 @@ def has_letters_and_numbers(inputString):
     return has_numbers(inputString) and has_letters(inputString)
 
 
-def sentences_train_test_validation_splitting_and_paragraph_generation(embeddings_mentions,file_name, splitting=(70,20,10)):
-    # embeddings_mentions = model.embeddings_mentions
+SPLIT_NAMES = ('train', 'test', 'validation')
 
-    paragraphs = pickle_call(file_name + '.pickle')
 
-    if paragraphs is None:
+class FlatCorpus(object):
+    """Documents stored as one contiguous int32 token array plus an int64 offsets array.
 
-        splitting = np.array(splitting)
-        splitting[1] += splitting[0]
-        splitting[2] += splitting[1]
+    Document i is tokens[offsets[i]:offsets[i + 1]], so indexing a corpus returns a
+    view and never copies tokens. Corpora are saved as two .npy files and loaded
+    memory-mapped.
+    """
 
-        splitting_counter = splitting[2]
+    def __init__(self, tokens, offsets):
+        self.tokens = tokens
+        self.offsets = offsets
 
-        train_sentences = []
-        test_sentences = []
-        validation_sentences = []
+    def __len__(self):
+        return len(self.offsets) - 1
 
-        with open(file_name, 'r') as f:
-            for line in f:
-                rand_int = random.randint(1, splitting_counter)
-                line_tokens = line.split()
-                token = []
-                for word in line_tokens:
-                    try:
-                        token.append(embeddings_mentions[word])
-                    except:
-                        pass
+    def __getitem__(self, i):
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
 
-                if rand_int <= splitting[0]:
-                    train_sentences.append(token)
-                elif rand_int <= splitting[1]:
-                    test_sentences.append(token)
-                else:
-                    validation_sentences.append(token)
-        paragraphs = [[],[],[]]
-        for i, sentences in enumerate([train_sentences, test_sentences, validation_sentences]):
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
 
-            sentences_length = len(sentences)
+    def lengths(self):
+        return np.diff(self.offsets)
 
-            for j in tqdm(xrange(len(sentences) * 10 )):
+    @staticmethod
+    def paths(prefix):
+        return prefix + '.tokens.npy', prefix + '.offsets.npy'
 
-                nr_sentences = random.randint(1, 10)
-                batch_sentence = []
+    @classmethod
+    def exists(cls, prefix):
+        return all(os.path.isfile(path) for path in cls.paths(prefix))
 
-                for k in xrange(nr_sentences):
-                    sentence = random.randint(0, sentences_length - 1)
-                    batch_sentence += sentences[sentence]
+    @classmethod
+    def load(cls, prefix, mmap_mode='r'):
+        tokens_file, offsets_file = cls.paths(prefix)
+        return cls(np.load(tokens_file, mmap_mode=mmap_mode), np.load(offsets_file, mmap_mode=mmap_mode))
 
-                paragraphs[i].append(batch_sentence)
-        pickle_dump(file_name + '.pickle', paragraphs)
+    def save(self, prefix):
+        for path, array in zip(self.paths(prefix), (self.tokens, self.offsets)):
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, array)
+            os.rename(path + '.tmp', path)
 
-    return paragraphs
 
+def ragged_range(starts, lengths):
+    """Concatenation of arange(start, start + length) for all pairs, without a Python loop."""
+    ends = np.cumsum(lengths)
+    return np.repeat(starts - ends + lengths, lengths) + np.arange(ends[-1] if len(ends) else 0)
 
 
-def sentence_to_token_ids(text, embeddings_mentions):
-    tokens = []
-    tok = tokenize(text, True, True)
-    for ment in tok:
-        try:
-            tokens.append(embeddings_mentions[ment])
-        except:
-            pass
-    return tokens
+def split_sentences(embeddings_mentions, file_name, splitting=(70,20,10), processes=1, chunk_size=1000000):
+    """Randomly assigns every line of file_name to the train, test or validation split.
 
+    The file is encoded chunk_size lines at a time with encode_texts.
 
-class LogFileWriter:
-    def __init__(self, filename):
-        self.filename = filename
-        self.open = False
-        self.file = open(filename, 'a')
+    Returns:
+      A list of three FlatCorpus objects holding the token ids of the sentences.
+    """
+    splitting = np.cumsum(splitting)
 
-    def __open__(self):
-        self.file = open(self.filename, 'a')
+    tokens = [[] for _ in SPLIT_NAMES]
+    lengths = [[] for _ in SPLIT_NAMES]
 
-    def append_text(self, text):
-        if not self.open:
-            self.__open__()
-        self.file.write(text + "\n")
-        self.close()
+    with open(file_name, 'r') as f:
+        while True:
+            lines = list(islice(f, chunk_size))
+            if not lines:
+                break
 
-    def close(self):
-        self.file.close()
+            chunk_tokens, chunk_offsets = encode_texts(lines, embeddings_mentions, whitespace=True, processes=processes)
+            chunk_lengths = np.diff(chunk_offsets)
+            splits = np.searchsorted(splitting, np.random.randint(1, splitting[2] + 1, size=len(lines)))
 
-def toy_text_generator(batch_size, buckets, data_set):
+            for split in xrange(len(SPLIT_NAMES)):
+                in_split = splits == split
+                tokens[split].append(chunk_tokens[ragged_range(chunk_offsets[:-1][in_split], chunk_lengths[in_split])])
+                lengths[split].append(chunk_lengths[in_split])
 
-    data_sizes = []
-    bucket_sizes = []
-    bucket_position = []
+    sentences = []
+    for split_tokens, split_lengths in zip(tokens, lengths):
+        split_lengths = np.concatenate(split_lengths) if split_lengths else np.zeros(0, dtype=np.int64)
+        offsets = np.zeros(len(split_lengths) + 1, dtype=np.int64)
+        np.cumsum(split_lengths, out=offsets[1:])
+        split_tokens = np.concatenate(split_tokens) if split_tokens else np.zeros(0, dtype=np.int32)
+        sentences.append(FlatCorpus(split_tokens.astype(np.int32, copy=False), offsets))
+    return sentences
+
+
+def generate_paragraphs(sentences, nr_paragraphs, max_sentences=10, random_state=np.random):
+    """Concatenates 1 - max_sentences random sentences into each of nr_paragraphs paragraphs.
 
-    max_len = buckets[-1][0]
+    Every paragraph is terminated by EOS_ID, so the generators can hand out views on the
+    paragraph corpus without appending to the documents.
+    """
+    if len(sentences) == 0:
+        return FlatCorpus(np.zeros(0, dtype=np.int32), np.zeros(1, dtype=np.int64))
+
+    nr_sentences = random_state.randint(1, max_sentences + 1, size=nr_paragraphs)
+    picked = random_state.randint(0, len(sentences), size=nr_sentences.sum())
+
+    starts = sentences.offsets[picked]
+    lengths = sentences.offsets[picked + 1] - starts
+    first_sentences = np.cumsum(nr_sentences) - nr_sentences
 
-    batch = []
-    data_buckets = [[] for _ in buckets]
+    offsets = np.zeros(nr_paragraphs + 1, dtype=np.int64)
+    np.cumsum(np.add.reduceat(lengths, first_sentences) + 1, out=offsets[1:])
 
-    nr_docs = 0
+    is_eos = np.zeros(offsets[-1], dtype=bool)
+    is_eos[offsets[1:] - 1] = True
+    tokens = np.empty(offsets[-1], dtype=np.int32)
+    tokens[is_eos] = EOS_ID
+    tokens[~is_eos] = sentences.tokens[ragged_range(starts, lengths)]
 
-    for data in data_set:
-        for i, size in enumerate(buckets):
-            if len(data) < buckets[i][0]:
-                data_buckets[i].append(data)
-                break
+    return FlatCorpus(tokens, offsets)
 
-    for data_ in data_buckets:
-        length = len(data_)
-        nr_docs += length
-        data_sizes.append(nr_docs)
-        bucket_sizes.append(length)
-        random.shuffle(data_)
-        bucket_position.append(0)
-
-    while True:
-
-        if bucket_sizes == bucket_position:
-            yield None, None
-            break
-        if batch == []:
-            while True:
-                rand_int = random.randint(1, nr_docs)
-                for bucket_nr, size in enumerate(data_sizes):
-                    if rand_int < size:
-                        break
-                if bucket_sizes[bucket_nr] != bucket_position[bucket_nr]:
-                    break
 
-        doc_position = bucket_position[bucket_nr]
-        token = data_buckets[bucket_nr][doc_position]
-        bucket_position[bucket_nr] += 1
+class ParagraphStream(object):
+    """Lazily samples EOS terminated paragraphs from a sentence FlatCorpus.
 
-        length = len(token)
+    Every epoch is nr_paragraphs paragraphs, drawn chunk by chunk with a RandomState
+    seeded by seed + epoch. Memory therefore stays proportional to the sentence
+    corpus and any epoch can be replayed exactly with iter_epoch. The stream keeps
+    no epoch counter, as it is usually iterated in a ParallelGenerator child
+    process; iterating over it yields epoch 0 and the train loops pass their epoch
+    down to toy_text_generator instead.
+    """
 
-        if length > max_len:
-            length = max_len
-            token = token[:length]
+    def __init__(self, sentences, nr_paragraphs, max_sentences=10, seed=0, chunk_size=10000):
+        self.sentences = sentences
+        self.nr_paragraphs = nr_paragraphs
+        self.max_sentences = max_sentences
+        self.seed = seed
+        self.chunk_size = chunk_size
 
-        batch.append(token + [EOS_ID])
+    def __len__(self):
+        return self.nr_paragraphs
 
-        if (len(batch) == batch_size) or (bucket_sizes[bucket_nr] == bucket_position[bucket_nr]):
-            yield batch, bucket_nr
-            batch  = []
+    def __iter__(self):
+        return self.iter_epoch(0)
 
+    def iter_epoch(self, epoch):
+        random_state = np.random.RandomState(self.seed + epoch)
+        for start in xrange(0, self.nr_paragraphs, self.chunk_size):
+            chunk = generate_paragraphs(self.sentences, min(self.chunk_size, self.nr_paragraphs - start),
+                                        self.max_sentences, random_state)
+            for paragraph in chunk:
+                yield paragraph
 
-def get_embedding_data(location, vocab_size,  all_entities=False):
 
-        pickle_file = 'data/embedding_data/embedding_data4.pickle'
+def split_cache_path(embeddings_mentions, file_name, splitting, vocab_key=None, **params):
+    """Cache path prefix of the splits of file_name encoded with a vocabulary.
 
-        embedding_data = pickle_call(pickle_file)
+    vocab_key identifies the vocabulary, e.g. by the embedding file it was loaded
+    from; without it the whole vocabulary is digested.
+    """
+    if vocab_key is None:
+        vocab_key = preprocessing.digest(sorted(embeddings_mentions.items()))
+    return preprocessing.cache_path(file_name, [file_name], vocab=vocab_key, splitting=tuple(splitting), **params)
 
-        if embedding_data is None:
 
-            embedding_data = {}
+def train_test_validation_sentences(embeddings_mentions, file_name, splitting=(70,20,10), vocab_key=None):
+    """Returns the train, test and validation sentences of file_name as FlatCorpus objects."""
+    prefixes = [split_cache_path(embeddings_mentions, file_name, splitting, vocab_key) + '.' + name + '_sentences'
+                for name in SPLIT_NAMES]
 
-            # location = config.location
-            embeddings_mentions = {}
-            embeddings_mentions_list = []
-            embeddings = []
+    if all(FlatCorpus.exists(prefix) for prefix in prefixes):
+        preprocessing.touch(path for prefix in prefixes for path in FlatCorpus.paths(prefix))
+    else:
+        for prefix, sentences in zip(prefixes, split_sentences(embeddings_mentions, file_name, splitting)):
+            sentences.save(prefix)
 
+    return [FlatCorpus.load(prefix) for prefix in prefixes]
 
-            print("retrieving embeddings from file")
 
-            i = 0
+def sentences_train_test_validation_splitting_and_paragraph_generation(embeddings_mentions,file_name, splitting=(70,20,10),
+                                                                       lazy=False, seed=0, vocab_key=None):
+    """Returns the train, test and validation paragraphs of file_name.
 
-            with open(location, 'r') as f:
-                for line in tqdm((f)):
+    By default the paragraphs are generated once, stored next to file_name as
+    FlatCorpus files keyed on the file, the vocabulary and the splitting, and
+    memory-mapped by later calls. With lazy set, a
+    ParagraphStream over the sentences of each split is returned instead.
+    vocab_key is passed on to split_cache_path.
+    """
+    if lazy:
+        return [ParagraphStream(sentences, len(sentences) * 10, seed=seed)
+                for sentences in train_test_validation_sentences(embeddings_mentions, file_name, splitting, vocab_key)]
 
-                    add = False
+    prefixes = [split_cache_path(embeddings_mentions, file_name, splitting, vocab_key, paragraphs=10) + '.' + name +
+                '_paragraphs' for name in SPLIT_NAMES]
 
-                    if i != 0:
+    if all(FlatCorpus.exists(prefix) for prefix in prefixes):
+        preprocessing.touch(path for prefix in prefixes for path in FlatCorpus.paths(prefix))
+    else:
+        for prefix, sentences in zip(prefixes, train_test_validation_sentences(embeddings_mentions, file_name, splitting,
+                                                                               vocab_key)):
+            generate_paragraphs(sentences, len(sentences) * 10).save(prefix)
 
-                        chunk = line.split(' ')
-                        mention = chunk[0]
-                        embedding = np.append(np.array([0.0, 0.0], dtype=np.float64),
-                                              np.array([float(j) for j in chunk[1:]], dtype=np.float64))
+    return [FlatCorpus.load(prefix) for prefix in prefixes]
+
+
+
+def sentence_to_token_ids(text, embeddings_mentions):
+    return encode_texts([text], embeddings_mentions, True, True)[0].tolist()
 
-                        if i == 1:
-                            eol = np.zeros(len(embedding), dtype=np.float64)
-                            eol[0] = 1.0
-                            start = np.zeros(len(embedding), dtype=np.float64)
-                            start[1] = 1.0
-                            pad = np.zeros(len(embedding), dtype=np.float64)
-                            embeddings.append(eol)
-                            embeddings.append(start)
-                            embeddings.append(pad)
-                            embeddings_mentions['!EOL!'] = 0
-                            embeddings_mentions['!START!'] = 1
-                            embeddings_mentions['!PAD!'] = 2
-                            embeddings_mentions_list.append('!EOL!')
-                            embeddings_mentions_list.append('!START!')
-                            embeddings_mentions_list.append('!PAD!')
 
-                        if i <= vocab_size:
-                            embeddings_mentions_list.append(mention)
+def pad_batch(data, length, batch_size, out=None):
+    """Pads a list of token id documents into a time-major batch and its weights.
 
-                            embeddings_mentions[mention] = i + 2
-                            embeddings.append(embedding)
+    Documents longer than length are cut, batch rows not covered by data are left
+    as PAD and every PAD position gets a weight of 0.
 
-                            add = True
+    Args:
+      data: list of at most batch_size token id documents (lists or int arrays).
+      length: number of time steps to pad to.
+      batch_size: number of rows of the batch.
+      out: optional pair of preallocated [batch_size, length] int32 and float32
+        arrays which are filled in place instead of allocating new ones.
+
+    Returns:
+      The pair (inputs, weights) of [length, batch_size] views on the batch-major
+      buffers, so inputs[l] is the vector of the l-th time step.
+    """
+    if out is None:
+        inputs = np.empty((batch_size, length), dtype=np.int32)
+        weights = np.empty((batch_size, length), dtype=np.float32)
+    else:
+        inputs, weights = out
+
+    lengths = np.zeros(batch_size, dtype=np.int64)
+    lengths[:len(data)] = [min(len(d), length) for d in data]
+
+    inputs.fill(PAD_ID)
+    if len(data) > 0:
+        inputs[np.arange(length) < lengths[:, None]] = np.concatenate([d[:length] for d in data])
+    np.not_equal(inputs, PAD_ID, out=weights)
+
+    return inputs.T, weights.T
+
+
+METRIC_FIELDS = ('step', 'bucket', 'perplexity', 'loss', 'learning_rate', 'step_time', 'tokens_per_sec')
+
+
+# Writers not closed yet, closed by one atexit hook so that a crashing training
+# loop still leaves its records behind.
+_open_log_writers = set()
+
+
+@atexit.register
+def _close_log_writers():
+    for writer in list(_open_log_writers):
+        try:
+            writer.close()
+        except Exception as e:
+            print("closing log file %s failed: %s" % (writer.filename, e))
+
+
+class LogFileWriter(object):
+    """Appends text lines and metric records to a log file from a background thread.
+
+    The file is opened by the constructor, so a bad path fails right away.
+    append_text and log only queue their line. The thread writes whatever is
+    queued in one go and flushes at most every flush_interval seconds. close, also
+    called at exit for writers still open, writes the rest and stops the thread.
+    An error of the thread is raised again by the next flush or close.
+
+    Records are written as ';' separated values of the METRIC_FIELDS they contain,
+    in that order, with format 'csv', or as one JSON object per line with 'jsonl'.
+    """
+
+    def __init__(self, filename, format='csv', flush_interval=5.0):
+        self.filename = filename
+        self.format = format
+        self.flush_interval = flush_interval
+        self.file = open(filename, 'a')
+        self.lines = queue.Queue()
+        self.closed = False
+        self.error = None
+        self.thread = threading.Thread(target=self._write_lines)
+        self.thread.daemon = True
+        self.thread.start()
+        _open_log_writers.add(self)
+
+    def _write_lines(self):
+        try:
+            self._write_queued()
+        except Exception:
+            self.error = sys.exc_info()
+        finally:
+            self.file.close()
+
+    def _write_queued(self):
+        last_flush = time.time()
+        while True:
+            try:
+                lines = [self.lines.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                lines = []
+            while True:
+                try:
+                    lines.append(self.lines.get_nowait())
+                except queue.Empty:
+                    break
+
+            # Besides text lines the queue holds None from close and the events
+            # flush waits on.
+            events = [line for line in lines if line is not None and not isinstance(line, str)]
+            done = None in lines
+            self.file.write(''.join(line + "\n" for line in lines if isinstance(line, str)))
+
+            if done or events or time.time() - last_flush >= self.flush_interval:
+                self.file.flush()
+                last_flush = time.time()
+            for event in events:
+                event.set()
+            if done:
+                break
+
+    def _raise_error(self):
+        if self.error is not None:
+            six.reraise(*self.error)
+
+    def append_text(self, text):
+        self.lines.put(str(text))
+
+    def log(self, **record):
+        if self.format == 'jsonl':
+            self.append_text(json.dumps(record, sort_keys=True))
+        else:
+            self.append_text(';'.join(str(record[field]) for field in METRIC_FIELDS if field in record))
+
+    def flush(self):
+        """Blocks until everything queued so far is written and flushed."""
+        if not self.closed:
+            flushed = threading.Event()
+            self.lines.put(flushed)
+            # The thread sets the event unless it died, which the polling catches.
+            while not flushed.wait(0.1) and self.thread.is_alive():
+                pass
+        self._raise_error()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.lines.put(None)
+            self.thread.join()
+            _open_log_writers.discard(self)
+        self._raise_error()
+
+
+def stream_text_generator(batch_size, buckets, data_set):
+    """Yields (batch, bucket_id) pairs from an iterable of documents, e.g. a ParagraphStream.
+
+    Documents are collected per bucket as they arrive and a batch is handed out as
+    soon as its bucket is full, the remaining partial batches follow at the end.
+    """
+    limits = [bucket[0] for bucket in buckets]
+    batches = [[] for _ in buckets]
+
+    for data in data_set:
+        bucket_nr = bisect_left(limits, len(data))
+        if bucket_nr == len(buckets):
+            continue
+        batches[bucket_nr].append(data)
+        if len(batches[bucket_nr]) == batch_size:
+            yield batches[bucket_nr], bucket_nr
+            batches[bucket_nr] = []
+
+    rest = [bucket_nr for bucket_nr, batch in enumerate(batches) if batch]
+    random.shuffle(rest)
+    for bucket_nr in rest:
+        yield batches[bucket_nr], bucket_nr
+    yield None, None
+
+
+def bucket_documents(buckets, data_set, random_state=np.random):
+    """Returns, per bucket, the shuffled indices of the FlatCorpus documents that fit into it first."""
+    bucket_ids = np.searchsorted([bucket[0] for bucket in buckets], data_set.lengths())
+    data_buckets = [np.flatnonzero(bucket_ids == i) for i in xrange(len(buckets))]
+    for data_ in data_buckets:
+        random_state.shuffle(data_)
+    return data_buckets
+
+
+def bucket_encoder_lengths(encoder_length, buckets):
+    """Per-bucket encoder lengths of one length for all buckets, a list of them, or None."""
+    if not encoder_length:
+        return None
+    if isinstance(encoder_length, (list, tuple)):
+        return list(encoder_length)
+    return [encoder_length] * len(buckets)
+
+
+def bucket_schedule(bucket_sizes, batch_size, random_state=np.random):
+    """Precomputes the batches of an epoch as a list of (bucket_nr, start, end) triples.
+
+    Each batch is taken from one of the buckets that still has documents, picked with
+    probability proportional to the bucket size. The cumulative sizes of the live
+    buckets are only rebuilt when a bucket runs empty, so every pick is one binary
+    search and never has to be retried.
+    """
+    bucket_sizes = np.asarray(bucket_sizes, dtype=np.int64)
+    positions = np.zeros(len(bucket_sizes), dtype=np.int64)
+    live = np.flatnonzero(bucket_sizes)
+    cumulative = np.cumsum(bucket_sizes[live])
+
+    schedule = []
+    while len(live) > 0:
+        bucket_nr = live[np.searchsorted(cumulative, random_state.randint(cumulative[-1]), side='right')]
+        start = positions[bucket_nr]
+        end = min(start + batch_size, bucket_sizes[bucket_nr])
+        schedule.append((int(bucket_nr), int(start), int(end)))
+        positions[bucket_nr] = end
+
+        if end == bucket_sizes[bucket_nr]:
+            live = live[live != bucket_nr]
+            cumulative = np.cumsum(bucket_sizes[live])
+
+    return schedule
+
+
+def toy_text_generator(batch_size, buckets, data_set, epoch=0):
+    """Yields (batch, bucket_id) pairs of EOS terminated documents from a FlatCorpus.
+
+    Documents are views on data_set. Every document is put into the first bucket
+    it fits into, documents longer than the largest bucket are skipped. Data sets
+    without random access, like a ParagraphStream, are bucketed on the fly by
+    stream_text_generator; a ParagraphStream yields the paragraphs of epoch.
+    """
+    if not isinstance(data_set, FlatCorpus):
+        if isinstance(data_set, ParagraphStream):
+            data_set = data_set.iter_epoch(epoch)
+        for batch, bucket_nr in stream_text_generator(batch_size, buckets, data_set):
+            yield batch, bucket_nr
+        return
+
+    data_buckets = bucket_documents(buckets, data_set)
+
+    for bucket_nr, start, end in bucket_schedule([len(data_) for data_ in data_buckets], batch_size):
+        yield [data_set[i] for i in data_buckets[bucket_nr][start:end]], bucket_nr
+    yield None, None
+
+
+def embedding_store_paths(location, nr_words, dtype=np.float32):
+    prefix = preprocessing.cache_path(location, [location], nr_words=nr_words, dtype=np.dtype(dtype).name)
+    return prefix + '.npy', prefix + '.vocab'
+
+
+def init_special_rows(embeddings_np):
+    """Fills the !EOL!, !START! and !PAD! rows of an embedding matrix and returns their mentions."""
+    embeddings_np[:3] = 0.0
+    embeddings_np[0, 0] = 1.0
+    embeddings_np[1, 1] = 1.0
+    return ['!EOL!', '!START!', '!PAD!']
+
+
+def embedding_matrix(mentions, vectors, nr_words, dtype=np.float32):
+    """Builds the mentions list and embedding matrix of the first nr_words in-memory vectors.
+
+    mentions and vectors are e.g. GensimW2VToy.keyed_vectors, in the order of
+    their word2vec file; the result matches what load_embedding_store returns for
+    that file, without writing and parsing it.
+    """
+    vectors = np.asarray(vectors)
+    nr_words = min(nr_words, len(vectors))
+    embeddings_np = np.empty((nr_words + 3, vectors.shape[1] + 2), dtype=dtype)
+    embeddings_mentions_list = init_special_rows(embeddings_np)
+    embeddings_np[3:, :2] = 0.0
+    embeddings_np[3:, 2:] = vectors[:nr_words]
+    return embeddings_mentions_list + list(mentions[:nr_words]), embeddings_np
+
+
+def _text_vector_chunks(f, nr_words, dim, chunk_size):
+    read = 0
+    while read < nr_words:
+        chunk = [line.rstrip().split(' ', 1) for line in islice(f, min(chunk_size, nr_words - read))]
+        if not chunk:
+            raise ValueError("%s ends after %d of %d vectors" % (f.name, read, nr_words))
+        values = np.fromstring(' '.join(c[1] for c in chunk), dtype=np.float32, sep=' ')
+        read += len(chunk)
+        yield [c[0] for c in chunk], values.reshape(len(chunk), dim)
 
 
+def _binary_vector_chunks(f, nr_words, dim, chunk_size, block_size=1 << 20):
+    row_bytes = 4 * dim
+    data, position, read = b'', 0, 0
+    while read < nr_words:
+        mentions, rows = [], []
+        while len(mentions) < min(chunk_size, nr_words - read):
+            space = data.find(b' ', position)
+            if space < 0 or len(data) < space + 1 + row_bytes:
+                block = f.read(block_size)
+                if not block:
+                    raise ValueError("%s ends after %d of %d vectors" % (f.name, read + len(mentions), nr_words))
+                data, position = data[position:] + block, 0
+                continue
+            mentions.append(data[position:space].lstrip(b'\n'))
+            rows.append(data[space + 1:space + 1 + row_bytes])
+            position = space + 1 + row_bytes
+        read += len(mentions)
+        yield mentions, np.frombuffer(b''.join(rows), dtype='<f4').reshape(len(mentions), dim)
 
-                    if i == 0: add = True
 
-                    if add:
+def build_embedding_store(location, nr_words, chunk_size=50000, dtype=np.float32):
+    """Converts the first nr_words vectors of a word2vec file into an embedding store.
 
-                        i += 1
+    Files ending in .bin are read in the binary word2vec format, all others as text.
+    The store is a .npy matrix of dtype, float32 or float16 to halve it at rest,
+    whose first three rows are the !EOL!, !START! and !PAD! vectors and whose
+    columns are prefixed by their two extra dimensions, plus a .vocab file holding
+    one mention per row of the matrix.
+    """
+    matrix_file, vocab_file = embedding_store_paths(location, nr_words, dtype)
 
-                    if (i == vocab_size and not all_entities):
-                        break
+    print("retrieving embeddings from file")
 
+    binary = location.endswith('.bin')
+    with open(location, 'rb' if binary else 'r') as f:
+        header = f.readline().split()
+        nr_words = min(nr_words, int(header[0]))
+        dim = int(header[1])
 
-            vocab_size = len(embeddings_mentions)
-            embedding_dim = len(embeddings[0])
-            embeddings_mentions_list = embeddings_mentions_list
-            embeddings_mentions = embeddings_mentions
-            embeddings_np = np.array(embeddings)
+        embeddings_np = np.lib.format.open_memmap(matrix_file + '.tmp', mode='w+', dtype=dtype,
+                                                  shape=(nr_words + 3, dim + 2))
+        embeddings_mentions_list = init_special_rows(embeddings_np)
 
-            print(str(vocab_size) + ' embeddings retrieved')
+        row = 3
+        chunks = _binary_vector_chunks if binary else _text_vector_chunks
+        for mentions, values in chunks(f, nr_words, dim, chunk_size):
+            embeddings_np[row:row + len(mentions), 2:] = values
+            embeddings_mentions_list.extend(mentions)
+            row += len(mentions)
 
-            embedding_data['vocab_size'] = vocab_size
-            embedding_data['embedding_dim'] = embedding_dim
-            embedding_data['embeddings_mentions_list'] = embeddings_mentions_list
-            embedding_data['embeddings_mentions'] = embeddings_mentions
-            embedding_data['embeddings_np'] = embeddings_np
+    embeddings_np.flush()
+    del embeddings_np
 
-            pickle_dump(pickle_file, embedding_data)
+    with open(vocab_file + '.tmp', 'w') as f:
+        f.write('\n'.join(embeddings_mentions_list) + '\n')
+
+    os.rename(matrix_file + '.tmp', matrix_file)
+    os.rename(vocab_file + '.tmp', vocab_file)
+
+
+def load_embedding_store(location, nr_words, dtype=np.float32):
+    """Memory-maps the embedding store of location, building it on first use."""
+    matrix_file, vocab_file = embedding_store_paths(location, nr_words, dtype)
+
+    if os.path.isfile(matrix_file) and os.path.isfile(vocab_file):
+        preprocessing.touch([matrix_file, vocab_file])
+    else:
+        build_embedding_store(location, nr_words, dtype=dtype)
+
+    embeddings_np = np.load(matrix_file, mmap_mode='r')
+    with open(vocab_file, 'r') as f:
+        embeddings_mentions_list = f.read().split('\n')[:-1]
+    embeddings_mentions = dict(zip(embeddings_mentions_list, xrange(len(embeddings_mentions_list))))
+
+    return embeddings_mentions_list, embeddings_mentions, embeddings_np
+
+
+def get_embedding_data(location, vocab_size,  all_entities=False, vectors=None, dtype=np.float32):
+
+        nr_words = vocab_size if all_entities else vocab_size - 1
+
+        if vectors is not None:
+            # (mentions, vectors) handed over in memory, e.g. by GensimW2VToy.keyed_vectors
+            embeddings_mentions_list, embeddings_np = embedding_matrix(vectors[0], vectors[1], nr_words, dtype)
+            embeddings_mentions = dict(zip(embeddings_mentions_list, xrange(len(embeddings_mentions_list))))
+        else:
+            embeddings_mentions_list, embeddings_mentions, embeddings_np = load_embedding_store(location, nr_words, dtype)
 
-        return embedding_data['vocab_size'], embedding_data['embedding_dim'], embedding_data['embeddings_mentions_list'], embedding_data['embeddings_mentions'], embedding_data['embeddings_np']
+        vocab_size = len(embeddings_mentions)
+        embedding_dim = embeddings_np.shape[1]
+
+        print(str(vocab_size) + ' embeddings retrieved')
+
+        return vocab_size, embedding_dim, embeddings_mentions_list, embeddings_mentions, embeddings_np
@@ -0,0 +1,100 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import tensorflow as tf
+
+# Every encoder layer is a VALID convolution of this many taps, the first one undilated.
+WIDTH = 3
+
+
+def receptive_field(dilations, width=WIDTH):
+    """Number of input tokens seen by one output of the first layer followed by the dilated ones."""
+    return 1 + (width - 1) * (1 + sum(dilations))
+
+
+def doubling_plan(tokens, width=WIDTH):
+    """Dilations 2, 4, 8, ... until the receptive field covers tokens, and that field.
+
+    This is the plan of the conv2d encoder, which pads the input to 2**(l+2)-1 tokens.
+    """
+    dilations = []
+    while receptive_field(dilations, width) < tokens:
+        dilations.append(2 ** (len(dilations) + 1))
+    return dilations, receptive_field(dilations, width)
+
+
+def exact_plan(tokens, width=WIDTH):
+    """Dilations 2, 4, 8, ... with the last one clamped so the receptive field just covers tokens.
+
+    The field grows in steps of width - 1, so it is tokens or, where that is not
+    reachable, tokens + 1.
+
+    Returns:
+      The pair (dilations, receptive field).
+    """
+    remaining = max(0, -(-(tokens - 1) // (width - 1)) - 1)
+    dilations = []
+    while remaining > 0:
+        dilations.append(min(2 ** (len(dilations) + 1), remaining))
+        remaining -= dilations[-1]
+    return dilations, receptive_field(dilations, width)
+
+
+def encoder_flops(cap, dilations, embedding_dim, filters, width=WIDTH):
+    """Floating point operations of the encoder convolutions for one row of cap tokens."""
+    flops, length, channels = 0, cap, embedding_dim
+    for dilation in [1] + list(dilations):
+        length -= (width - 1) * dilation
+        flops += 2 * length * width * channels * filters
+        channels = filters
+    return flops
+
+
+def conv1d_encoder(inputs, dilations, filters, keep_prob, static=True, width=WIDTH):
+    """Dilated encoder over [batch_size, length, embedding_dim] inputs.
+
+    The layers are 1-D VALID convolutions along the time axis followed by separate
+    bias, ReLU and dropout ops; tf.nn.convolution wraps the dilated ones in
+    SpaceToBatchND/BatchToSpaceND, so they are not fused. The gain over the conv2d
+    engine is the shorter input of exact_plan. The variables have the names and
+    shapes of DilatedCNN's conv2d encoder, so checkpoints restore in either engine.
+
+    Returns:
+      The [batch_size, length - receptive field + 1, filters] output of the last layer.
+    """
+    xavier = tf.contrib.layers.xavier_initializer()
+
+    def layer(layer_inputs, w, b, dilation, name):
+        conv = tf.nn.convolution(layer_inputs, tf.squeeze(w, [0]), 'VALID', dilation_rate=[dilation])
+        outputs = tf.nn.relu(tf.nn.bias_add(conv, b), name=name)
+        if keep_prob < 1:
+            outputs = tf.nn.dropout(outputs, keep_prob=keep_prob)
+        return outputs
+
+    first_w = tf.get_variable("first_w", shape=[1, width, inputs.shape[2].value, filters], initializer=xavier)
+    first_b = tf.get_variable("first_b", initializer=tf.constant(0.01, shape=[filters]))
+    outputs = layer(inputs, first_w, first_b, 1, "relu")
+
+    if static:
+        w = tf.get_variable("dilated_weight", shape=[1, width, filters, filters], initializer=xavier)
+        b = tf.get_variable("dilated_biase", initializer=tf.constant(0.01, shape=[filters]))
+    for l, dilation in enumerate(dilations):
+        if not static:
+            w = tf.get_variable("dilated_weights_" + str(l), shape=[1, width, filters, filters], initializer=xavier)
+            b = tf.get_variable("dilated_biases_" + str(l), initializer=tf.constant(0.01, shape=[filters]))
+        outputs = layer(outputs, w, b, dilation, "dilated_outputs_" + str(l))
+    return outputs
+
+
+def print_encoder_report(config, embedding_dim):
+    """Prints the input length, layers and FLOPs per row of both encoder plans for every bucket."""
+    filters = config.hidden_size * config.num_layers
+    print("Encoder FLOPs per row:")
+    for bucket in config.buckets:
+        line = []
+        for name, plan in (('doubling', doubling_plan), ('exact', exact_plan)):
+            dilations, cap = plan(bucket[0])
+            line.append("%s cap %d, %d layers, %.1f MFLOPs" % (
+                name, cap, len(dilations), encoder_flops(cap, dilations, embedding_dim, filters) / 1e6))
+        print("  bucket %-3d %s" % (bucket[0], ' | '.join(line)))
@@ -0,0 +1,128 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import functools
+import tensorflow as tf
+import data_utils as data_utils
+
+
+def sequence_lengths(weights):
+    """Number of non-PAD positions of every row of a [batch_size, length] weight mask."""
+    return tf.reduce_sum(tf.cast(tf.greater(weights, 0), tf.int32), axis=1)
+
+
+def project(outputs, output_projection):
+    """Applies the (w, b) output projection to [batch_size, length, size] outputs."""
+    w, b = output_projection
+    logits = tf.reshape(tf.nn.xw_plus_b(tf.reshape(outputs, [-1, tf.shape(outputs)[2]]), w, b),
+                        tf.concat([tf.shape(outputs)[:2], [-1]], axis=0))
+    logits.set_shape(outputs.shape[:2].concatenate(w.shape[1:]))
+    return logits
+
+
+def pad_lengths(targets):
+    """Number of non-PAD tokens of every row of [batch_size, length] targets padded at the end."""
+    return tf.reduce_sum(tf.cast(tf.not_equal(targets, data_utils.PAD_ID), tf.int32), axis=1)
+
+
+def dynamic_encoder(cell, embeddings, targets, dtype, scope="tied_rnn_seq2seq"):
+    """Encodes every row of [batch_size, length] targets backwards, skipping its PAD steps.
+
+    Each row is reversed up to its last non-PAD token, so dynamic_rnn reads the
+    tokens in the order of tied_rnn_seq2seq's reversed encoder inputs, stops at
+    the row's length and returns the state after its first token. The variables
+    are created under scope like the ones of static_rnn.
+
+    Returns:
+      The final cell state of every row.
+    """
+    lengths = pad_lengths(targets)
+    inputs = tf.reverse_sequence(tf.nn.embedding_lookup(embeddings, targets), lengths, seq_axis=1, batch_axis=0)
+    _, state = tf.nn.dynamic_rnn(cell, inputs, sequence_length=lengths, dtype=dtype, scope=scope)
+    return state
+
+
+def dynamic_decoder(cell, initial_state, embeddings, targets, weights, output_projection=None, feed_previous=False,
+                    scope="rnn_decoder"):
+    """Runs an RNN decoder over [batch_size, length] targets of any length in a while_loop.
+
+    Like legacy_seq2seq.rnn_decoder the decoder starts from GO_ID and reads the
+    embedded targets shifted by one, or with feed_previous its own argmax
+    predictions. Every row stops at its number of non-PAD positions, later outputs
+    are zero. The variables are created under scope like the ones of rnn_decoder,
+    so checkpoints can be restored by both.
+
+    Returns:
+      The [batch_size, length, cell.output_size] outputs.
+    """
+    lengths = sequence_lengths(weights)
+    batch_size = tf.shape(targets)[0]
+    go = tf.fill([batch_size, 1], data_utils.GO_ID)
+
+    if not feed_previous:
+        inputs = tf.nn.embedding_lookup(embeddings, tf.concat([go, targets[:, :-1]], axis=1))
+        outputs, _ = tf.nn.dynamic_rnn(cell, inputs, sequence_length=lengths, initial_state=initial_state,
+                                       dtype=embeddings.dtype, scope=scope)
+        return outputs
+
+    go_input = tf.nn.embedding_lookup(embeddings, go[:, 0])
+
+    def loop_fn(time, cell_output, cell_state, loop_state):
+        finished = time >= lengths
+        if cell_output is None:
+            return finished, go_input, initial_state, None, None
+        logits = cell_output
+        if output_projection is not None:
+            logits = tf.nn.xw_plus_b(cell_output, output_projection[0], output_projection[1])
+        # Like the legacy loop function, no gradient flows through the fed back predictions.
+        next_input = tf.stop_gradient(tf.nn.embedding_lookup(embeddings, tf.argmax(logits, 1)))
+        return finished, next_input, cell_state, cell_output, None
+
+    outputs_ta, _, _ = tf.nn.raw_rnn(cell, loop_fn, scope=scope)
+    outputs = tf.transpose(outputs_ta.stack(), [1, 0, 2])
+    # raw_rnn stops after the longest row, the targets may be padded further.
+    outputs = tf.pad(outputs, [[0, 0], [0, tf.shape(targets)[1] - tf.shape(outputs)[1]], [0, 0]])
+    outputs.set_shape([None, None, cell.output_size])
+    return outputs
+
+
+def sequence_loss(outputs, targets, weights, output_projection, softmax_loss_function=None):
+    """legacy_seq2seq.sequence_loss of [batch_size, length] targets and weights.
+
+    Without softmax_loss_function the outputs are projected with output_projection
+    and scored with the full softmax.
+    """
+    flat_outputs = tf.reshape(outputs, [-1, outputs.shape[2].value])
+    labels = tf.reshape(targets, [-1])
+    if softmax_loss_function is None:
+        crossent = tf.nn.sparse_softmax_cross_entropy_with_logits(
+            labels=labels, logits=tf.nn.xw_plus_b(flat_outputs, output_projection[0], output_projection[1]))
+    else:
+        crossent = softmax_loss_function(labels=labels, logits=flat_outputs)
+    crossent = tf.reshape(crossent, tf.shape(targets)) * weights
+    log_perps = tf.reduce_sum(crossent, axis=1) / (tf.reduce_sum(weights, axis=1) + 1e-12)
+    return tf.reduce_sum(log_perps) / tf.cast(tf.shape(targets)[0], log_perps.dtype)
+
+
+def clipped_update(optimizer, loss, params, max_gradient_norm, global_step):
+    """Returns the update op applying the clipped gradients of loss, and the gradient norm."""
+    gradients = tf.gradients(loss, params)
+    clipped_gradients, norm = tf.clip_by_global_norm(gradients, max_gradient_norm)
+    return optimizer.apply_gradients(zip(clipped_gradients, params), global_step=global_step), norm
+
+
+def select_bucket(bucket_id, nr_buckets, bucket_loss):
+    """Loss of the bucket picked by the bucket_id scalar tensor at run time.
+
+    bucket_loss(j) builds the loss of bucket j inside a branch of a tf.case, so a
+    step only runs the forward and backward graph of its own bucket while the
+    gradient of the result, and an update applying it, is built only once. The
+    branches share their variables.
+    """
+    def branch(j):
+        with tf.variable_scope(tf.get_variable_scope(), reuse=tf.AUTO_REUSE):
+            return bucket_loss(j)
+
+    pairs = [(tf.equal(bucket_id, j), functools.partial(branch, j)) for j in range(nr_buckets - 1)]
+    return tf.case(pairs, default=functools.partial(branch, nr_buckets - 1))
@@ -2,16 +2,89 @@ import numpy as np
 from gensim.models import Word2Vec
 import sys
 import os.path
+import glob
+import re
 reload(sys)  # Reload does the trick!
 sys.setdefaultencoding('UTF8') #UTF8 #latin-1
 import logging
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
-from random import shuffle
+import random
+import preprocessing
+
+class ShuffledCorpus(object):
+    """Streams the whitespace tokenized lines of a file in approximately random order.
+
+    The file is cut at line boundaries into shards of about shard_size bytes. Every
+    epoch reads the shards in a new random order, each of them sequentially, and
+    passes the lines through a shuffle buffer of buffer_size sentences, so memory
+    stays bounded by the buffer whatever the size of the file. Like
+    data_utils.ParagraphStream every iteration is a new epoch seeded by
+    seed + epoch, which iter_epoch replays.
+    """
+
+    def __init__(self, file_name, shard_size=16 * 1024 * 1024, buffer_size=100000, seed=0):
+        self.file_name = file_name
+        self.shard_size = shard_size
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.epoch = 0
+        self.shards = self.shard_offsets()
+
+    def shard_offsets(self):
+        """(start, end) byte offsets of the shards, every start being the start of a line."""
+        size = os.path.getsize(self.file_name)
+        starts = [0]
+        with open(self.file_name, 'rb') as f:
+            for position in xrange(self.shard_size, size, self.shard_size):
+                if position <= starts[-1]:
+                    continue
+                f.seek(position - 1)
+                f.readline()
+                if f.tell() >= size:
+                    break
+                starts.append(f.tell())
+        return list(zip(starts, starts[1:] + [size]))
+
+    def __iter__(self):
+        self.epoch += 1
+        return self.iter_epoch(self.epoch - 1)
+
+    def iter_epoch(self, epoch):
+        random_state = random.Random(self.seed + epoch)
+        shards = list(self.shards)
+        random_state.shuffle(shards)
+
+        sentences = []
+        with open(self.file_name, 'rb') as f:
+            for start, end in shards:
+                f.seek(start)
+                while start < end:
+                    line = f.readline()
+                    start += len(line)
+                    if len(sentences) < self.buffer_size:
+                        sentences.append(line.split())
+                    else:
+                        i = random_state.randrange(self.buffer_size)
+                        yield sentences[i]
+                        sentences[i] = line.split()
+
+        random_state.shuffle(sentences)
+        for sentence in sentences:
+            yield sentence
+
 
 class GensimW2VToy:
 
-    def __init__(self,file_name, destination, reload=True, size=300, window=5, min_count=5, workers=4):
+    def __init__(self,file_name, destination, reload=True, size=300, window=5, min_count=5, workers=4,
+                 shard_size=16 * 1024 * 1024, buffer_size=100000, corpus_file=False, cache_dir=None, shuffles=1):
         self.file_name = file_name
+        self.corpus = ShuffledCorpus(file_name, shard_size, buffer_size)
+        # corpus_file mode trains from shuffles line sentence copies of the corpus, written
+        # once to cache_dir or next to the corpus, that gensim's workers read themselves
+        # instead of sharing one Python iterator; epoch i reads copy i % shuffles
+        self.corpus_file = corpus_file
+        self.cache_dir = cache_dir
+        self.shuffles = shuffles
         self.destination = destination
         self.model = Word2Vec( iter=1, size=size, window=window, min_count=min_count, workers=workers, sg=1, alpha=1, min_alpha= 0.00001, negative=10 , sorted_vocab=1)
 
@@ -21,35 +94,118 @@ class GensimW2VToy:
         self.model = Word2Vec.load(file_name)
 
     def build_generator(self, file, yields=1):
-        tokens = []
-        with open(file, 'r') as f:
-            for line in f:
-                line_tokens = line.split()
-                tokens.append(line_tokens)
-
+        corpus = self.corpus if file == self.file_name else ShuffledCorpus(file)
         for yield_ in xrange(yields):
-            shuffle(tokens)
-            for token in tokens:
-                yield token
+            for sentence in corpus:
+                yield sentence
+
+    def line_sentence_file(self, file, epoch=0):
+        """Writes the sentences of file in gensim's line sentence format, shuffled like epoch.
+
+        The file is keyed by the identity of file, the shuffling parameters and epoch,
+        so an edited corpus is not trained from a stale copy, and is reused as long
+        as it exists.
+        """
+        corpus = self.corpus if file == self.file_name else ShuffledCorpus(file)
+        prefix = os.path.join(self.cache_dir or os.path.dirname(file), os.path.basename(file))
+        line_sentences = preprocessing.cache_path(prefix, [file], shard_size=corpus.shard_size,
+                                                  buffer_size=corpus.buffer_size, seed=corpus.seed,
+                                                  epoch=epoch) + '.line_sentences'
+        if not os.path.isfile(line_sentences):
+            with open(line_sentences + '.tmp', 'wb') as f:
+                for sentence in corpus.iter_epoch(epoch):
+                    f.write(' '.join(sentence) + '\n')
+            os.rename(line_sentences + '.tmp', line_sentences)
+        return line_sentences
+
+    def line_sentence_files(self, file):
+        """Writes the shuffles copies of file that do not exist yet and returns their names."""
+        return [self.line_sentence_file(file, shuffle) for shuffle in xrange(self.shuffles)]
 
     def build_dict(self, file):
+        if self.corpus_file:
+            # The vocabulary does not depend on the order, any copy will do.
+            self.model.build_vocab(corpus_file=self.line_sentence_files(file)[0], progress_per=100, update=False)
+            return
         generator = self.build_generator(file)
         self.model.build_vocab(generator, keep_raw_vocab=False, trim_rule=None, progress_per=100, update=False)
 
+    def train_epoch(self, epoch, start_alpha, end_alpha):
+        """Runs one epoch over the corpus and returns gensim's (trained, raw) word counts."""
+        if self.corpus_file:
+            return self.model.train(corpus_file=self.line_sentence_file(self.file_name, epoch % self.shuffles),
+                                    total_examples=self.model.corpus_count, total_words=self.model.corpus_total_words,
+                                    epochs=1, start_alpha=start_alpha, end_alpha=end_alpha, word_count=0,
+                                    report_delay=1.0, compute_loss=None)
+        return self.model.train(self.corpus.iter_epoch(epoch), total_examples=self.model.corpus_count, total_words=None, epochs=1, start_alpha=start_alpha, end_alpha=end_alpha,
+                  word_count=0, queue_factor=2, report_delay=1.0, compute_loss=None)
+
+
+    def keyed_vectors(self):
+        """The (mentions, vectors) pair of the trained model for data_utils.get_embedding_data.
+
+        The words are in the order save_word2vec_format writes them, by descending
+        count, so the first vocab_size of them are those of the vectors file.
+        """
+        wv = self.model.wv
+        words = [word for word, _ in sorted(wv.vocab.items(), key=lambda item: -item[1].count)]
+        return words, wv.vectors[[wv.vocab[word].index for word in words]]
+
+    def snapshot_name(self, epoch, alpha):
+        return self.destination + '_epoche_' + str(epoch) + '_lr_' + str(alpha)
+
+    def snapshots(self):
+        """(epoch, file_name) pairs of the saved models, sorted by epoch."""
+        snapshots = []
+        for file_name in glob.glob(self.destination + '_epoche_*_lr_*'):
+            match = re.match(re.escape(self.destination) + r'_epoche_(\d+)_lr_([0-9.e+-]+)$', file_name)
+            if match:
+                snapshots.append((int(match.group(1)), file_name))
+        return sorted(snapshots)
+
+    def vectors_file(self, file_name, binary=True):
+        return file_name + '_vectors' + ('.bin' if binary else '')
+
+    def remove_snapshots(self, keep_last):
+        """Removes all but the keep_last most recent snapshots with their vectors."""
+        if keep_last < 1:
+            raise ValueError("keep_last must be at least 1, got %r" % (keep_last,))
+        snapshots = self.snapshots()
+        for _, file_name in snapshots[:len(snapshots) - keep_last]:
+            for path in [file_name, self.vectors_file(file_name), self.vectors_file(file_name, False)] + \
+                    glob.glob(file_name + '.*.npy'):
+                if os.path.isfile(path):
+                    os.remove(path)
+
+    def train(self, epochs=10, start_alpha=0.025, end_alpha=0.0001, checkpoint_every=1, keep_last=2, binary=True):
+        """Trains epochs epochs, resuming after the latest snapshot of destination.
+
+        The model and its vectors are saved every checkpoint_every epochs and after the
+        last one, keeping the keep_last most recent snapshots. The vectors are written
+        in the binary word2vec format, or as text without binary.
 
-    def train(self, epochs=10, start_alpha=0.025, end_alpha=0.0001):
+        Returns:
+          The vectors file of the last epoch.
+        """
+        if keep_last < 1:
+            raise ValueError("keep_last must be at least 1, got %r" % (keep_last,))
+        alphas = np.linspace(start_alpha, end_alpha, epochs)
 
-        for i , new_start_alpha in enumerate(np.linspace(start_alpha,end_alpha,epochs)):
-            file_name = self.destination + '_epoche_' + str(i) + '_lr_' + str(new_start_alpha)
+        first_epoch = 0
+        snapshots = self.snapshots()
+        if snapshots:
+            epoch, file_name = snapshots[-1]
+            self.load_model_from_file(file_name)
+            print file_name + ' loaded'
+            first_epoch = epoch + 1
 
-            if os.path.isfile(file_name):
-                self.load_model_from_file(file_name)
-                print file_name + 'loaded'
-            else:
-                generator = self.build_generator(self.file_name, 1)
-                self.model.train(generator, total_examples=self.model.corpus_count, total_words=None, epochs=1, start_alpha=new_start_alpha, end_alpha=end_alpha,
-                          word_count=0, queue_factor=2, report_delay=1.0, compute_loss=None)
-                self.model.wv.save_word2vec_format(file_name+"_vectors")
-                self.model.save(file_name )
+        for i in xrange(first_epoch, epochs):
+            self.train_epoch(i, alphas[i], end_alpha)
 
+            if (i + 1) % checkpoint_every == 0 or i == epochs - 1:
+                file_name = self.snapshot_name(i, alphas[i])
+                self.model.wv.save_word2vec_format(self.vectors_file(file_name, binary), binary=binary)
+                self.model.save(file_name)
+                self.remove_snapshots(keep_last)
 
+        return self.vectors_file(self.snapshots()[-1][1], binary)
@@ -0,0 +1,102 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+import data_utils as data_utils
+
+
+class DatasetInputs(object):
+    """tf.data input mode: per-bucket iterators that pad and prefetch inside the graph.
+
+    Every bucket gets a reinitializable iterator whose next element is a dict with
+    the [rows, length] int32 "targets" matrix and float32 "weights" mask of the
+    bucket and, with an encoder_length, the "encoder" matrix padded to it. The
+    encoder_length is one length for all buckets or a list of per-bucket lengths. The
+    models build their graphs straight on these tensors, so a step needs no feed.
+
+    Data sets are registered once with add_data_set, which builds one dataset per
+    bucket reading its documents from the FlatCorpus. start runs the initializers
+    of a data set and returns the bucket ids of its epoch in the order of
+    data_utils.bucket_schedule; running the model on bucket b pulls the next batch
+    of b, so following that order consumes every batch exactly once.
+    """
+
+    def __init__(self, buckets, rows, encoder_length=None, prefetch=2):
+        self.buckets = buckets
+        self.rows = rows
+        self.encoder_lengths = data_utils.bucket_encoder_lengths(encoder_length, buckets)
+        self.prefetch = prefetch
+        self.data_sets = {}
+
+        self.iterators = []
+        self.inputs = []
+        for bucket_nr, (length, _) in enumerate(buckets):
+            types = {'targets': tf.int32, 'weights': tf.float32}
+            shapes = {'targets': tf.TensorShape([rows, length]), 'weights': tf.TensorShape([rows, length])}
+            if self.encoder_lengths:
+                types['encoder'] = tf.int32
+                shapes['encoder'] = tf.TensorShape([rows, self.encoder_lengths[bucket_nr]])
+            iterator = tf.data.Iterator.from_structure(types, shapes)
+            self.iterators.append(iterator)
+            self.inputs.append(iterator.get_next())
+
+    def _bucket_dataset(self, data_set, data_buckets, bucket_nr, batch_size):
+        length = self.buckets[bucket_nr][0]
+
+        def documents():
+            doc_ids = data_buckets[bucket_nr].copy()
+            np.random.shuffle(doc_ids)
+            for i in doc_ids:
+                yield np.asarray(data_set[i], dtype=np.int32)
+
+        def finish(batch):
+            batch = tf.pad(batch, [[0, self.rows - tf.shape(batch)[0]], [0, 0]],
+                           constant_values=data_utils.PAD_ID)
+            batch.set_shape([self.rows, length])
+            element = {'targets': batch,
+                       'weights': tf.cast(tf.not_equal(batch, data_utils.PAD_ID), tf.float32)}
+            if self.encoder_lengths:
+                element['encoder'] = tf.pad(batch, [[0, 0], [0, self.encoder_lengths[bucket_nr] - length]],
+                                            constant_values=data_utils.PAD_ID)
+            return element
+
+        dataset = tf.data.Dataset.from_generator(documents, tf.int32, tf.TensorShape([None]))
+        dataset = dataset.padded_batch(batch_size, padded_shapes=[length],
+                                       padding_values=np.int32(data_utils.PAD_ID))
+        return dataset.map(finish).prefetch(self.prefetch)
+
+    def add_data_set(self, name, batch_size, data_set):
+        """Builds the per-bucket datasets of a FlatCorpus and their iterator initializers."""
+        data_buckets = data_utils.bucket_documents(self.buckets, data_set)
+        initializers = [iterator.make_initializer(self._bucket_dataset(data_set, data_buckets, bucket_nr, batch_size))
+                        for bucket_nr, iterator in enumerate(self.iterators)]
+        self.data_sets[name] = (batch_size, [len(data_) for data_ in data_buckets], initializers)
+
+    def start(self, session, name):
+        """Points the iterators at a registered data set and returns its epoch's bucket ids."""
+        batch_size, bucket_sizes, initializers = self.data_sets[name]
+        session.run(initializers)
+        return [bucket_nr for bucket_nr, _, _ in data_utils.bucket_schedule(bucket_sizes, batch_size)]
+
+
+def dataset_inputs(config, encoder_length=None):
+    """DatasetInputs over config.train_args and config.test_args, or None in feed mode."""
+    if config.input_mode != 'dataset':
+        return None
+
+    inputs = DatasetInputs(config.buckets, config.batch_size, encoder_length)
+    inputs.add_data_set('train', config.train_args[0], config.train_args[2])
+    inputs.add_data_set('test', config.test_args[0], config.test_args[2])
+    return inputs
+
+
+def dataset_batches(inputs, session, name):
+    """Yields (None, None, None, bucket_id) for the epoch of a data set registered with inputs.
+
+    The tuples mirror batch_loader.batches, the Nones telling step that there is
+    nothing to feed.
+    """
+    for bucket_id in inputs.start(session, name):
+        yield None, None, None, bucket_id
@@ -0,0 +1,71 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import resource
+import numpy as np
+import tensorflow as tf
+import data_utils as data_utils
+
+
+def resident_bytes():
+    """Current resident set size of the process, or its peak where /proc is missing."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _array_note(array):
+    return '%s, %s' % (array.dtype, 'memory-mapped' if isinstance(array, np.memmap) else 'in memory')
+
+
+def _variable_bytes(variables):
+    return sum(variable.shape.num_elements() * variable.dtype.base_dtype.size for variable in variables)
+
+
+def memory_report(config, model=None):
+    """Breaks the memory of a training run down into (name, bytes, note) rows.
+
+    The rows cover the host embedding matrix and the token arrays of the data sets
+    of config and, given a model, the embedding variable, the other graph variables
+    and the optimizer slots, followed by the resident memory of the process.
+    Memory-mapped arrays only take resident memory for the pages that were read.
+    """
+    rows = [('embeddings', config.embeddings_np.nbytes, _array_note(config.embeddings_np))]
+
+    for name in ('train_set', 'test_set', 'validation_set'):
+        data_set = getattr(config, name)
+        if isinstance(data_set, data_utils.ParagraphStream):
+            data_set = data_set.sentences
+        if isinstance(data_set, data_utils.FlatCorpus):
+            rows.append((name, data_set.tokens.nbytes + data_set.offsets.nbytes, _array_note(data_set.tokens)))
+
+    if model is not None:
+        optimizer = getattr(model, 'optimizer', None)
+        slots = []
+        if optimizer is not None:
+            slots = [optimizer.get_slot(variable, slot_name) for variable in tf.trainable_variables()
+                     for slot_name in optimizer.get_slot_names()]
+            slots = [slot for slot in slots if slot is not None]
+        slot_names = set(slot.name for slot in slots)
+        variables = [variable for variable in tf.global_variables()
+                     if variable.name not in slot_names and variable is not model.embeddings]
+
+        rows.append(('embedding variable', _variable_bytes([model.embeddings]), str(model.embeddings.dtype.base_dtype.name)))
+        rows.append(('graph variables', _variable_bytes(variables), '%d variables' % len(variables)))
+        rows.append(('optimizer slots', _variable_bytes(slots), '%d slots' % len(slots)))
+
+    rows.append(('resident', resident_bytes(), 'process total'))
+    return rows
+
+
+def print_memory_report(config, model=None):
+    rows = memory_report(config, model)
+    print("Memory:")
+    for name, size, note in rows:
+        print("  %-20s %10.1f MB  %s" % (name, size / 2.0 ** 20, note))
@@ -2,21 +2,135 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+import numpy as np
 import tensorflow as tf
 import data_utils as data_utils
+import sample_vocab as sample_vocab
+import preprocessing as preprocessing
 from data_utils import get_embedding_data
 
 def data_type():
   return  tf.float32
 
-BASIC = "basic"
-CUDNN = "cudnn"
-BLOCK = "block"
+from rnn_cells import BASIC, CUDNN, BLOCK
 
 
 
-class TestConfigToy(object):
-    def __init__(self):
+def embedding_initial_value(embeddings_np):
+    """Tensor reading the embedding matrix from the host when the variable is initialized.
+
+    Neither the graph definition nor a feed carries a copy of the matrix, and a
+    memory-mapped matrix is read straight from its file.
+    """
+    dtype = data_type().as_numpy_dtype
+    value = tf.py_func(lambda: np.asarray(embeddings_np, dtype=dtype), [], data_type(), name='embedding_values')
+    value.set_shape(embeddings_np.shape)
+    return value
+
+
+EMBEDDING_ATTRIBUTES = ('vocab_size', 'embedding_dim', 'embeddings_mentions_list', 'embeddings_mentions',
+                        'embeddings_np')
+DATA_SET_ATTRIBUTES = ('train_set', 'test_set', 'validation_set')
+
+# Loaded embedding data and data sets by their parameters, shared by all configs of the process.
+_data_cache = {}
+
+
+class LazyDataConfig(object):
+    """Base of the configs that loads the embedding data and data sets on first access.
+
+    The EMBEDDING_ATTRIBUTES are loaded from location, or built from in-memory
+    vectors, the first time one of them is read, and the DATA_SET_ATTRIBUTES are
+    split from corpus_file the first time a data set is read. Both are cached in the
+    process by the parameters they depend on, so creating a config is cheap and all
+    configs of a sweep share one load. max_vocab_size is the number of embeddings
+    requested, vocab_size the number loaded.
+    """
+
+    def __init__(self, location, vectors=None):
+        self.location = location
+        self.vectors = vectors
+        self.corpus_file = 'data/text_data/raw_sentences.txt'
+        self.splitting = (70, 20, 10)
+        self.lazy_paragraphs = False
+        self.shrink_vocab = False  # keep only the words of the train split
+        self.shrink_vocab_top_k = None
+        self.embedding_dtype = np.float32  # np.float16 halves the embeddings at rest
+        # limits of the preprocessing caches next to location and corpus_file
+        self.cache_max_bytes = None
+        self.cache_max_age = None
+
+    def __getattr__(self, name):
+        # only called for attributes that are not set yet
+        if name in DATA_SET_ATTRIBUTES or name in EMBEDDING_ATTRIBUTES and self.shrink_vocab:
+            self.__dict__.update(self._data())
+        elif name in EMBEDDING_ATTRIBUTES:
+            self.__dict__.update(self._embedding_data())
+        else:
+            raise AttributeError(name)
+        return self.__dict__[name]
+
+    @property
+    def train_args(self):
+        return self.batch_size, self.buckets, self.train_set
+
+    @property
+    def test_args(self):
+        return self.test_batch_size, self.buckets, self.test_set
+
+    def _evict_cache(self, file_name):
+        if self.cache_max_bytes is not None or self.cache_max_age is not None:
+            preprocessing.evict_cache(os.path.dirname(file_name) or '.', self.cache_max_bytes, self.cache_max_age)
+
+    def _embedding_key(self):
+        return (self.location, self.max_vocab_size, np.dtype(self.embedding_dtype).name,
+                None if self.vectors is None else id(self.vectors))
+
+    def _embedding_data(self):
+        key = ('embeddings',) + self._embedding_key()
+        if key not in _data_cache:
+            self._evict_cache(self.location)
+            # the vectors are kept alive with the entry so that their id stays unique
+            _data_cache[key] = self.vectors, get_embedding_data(self.location, self.max_vocab_size,
+                                                                vectors=self.vectors, dtype=self.embedding_dtype)
+        return dict(zip(EMBEDDING_ATTRIBUTES, _data_cache[key][1]))
+
+    def _vocab_key(self, embeddings_mentions_list):
+        """Key of the vocabulary in the split caches.
+
+        A vocabulary loaded from location is keyed by that file and max_vocab_size,
+        which is cheaper than digesting it. In-memory vectors have no such source
+        and are keyed by their words.
+        """
+        if self.vectors is None:
+            return preprocessing.digest((preprocessing.file_identity(self.location), self.max_vocab_size))
+        return preprocessing.digest(embeddings_mentions_list)
+
+    def _data(self):
+        key = ('data',) + self._embedding_key() + (self.corpus_file, self.splitting, self.lazy_paragraphs,
+                                                    self.shrink_vocab, self.shrink_vocab_top_k)
+        if key not in _data_cache:
+            embedding_data = self._embedding_data()
+            self._evict_cache(self.corpus_file)
+            data_sets = data_utils.sentences_train_test_validation_splitting_and_paragraph_generation(
+                embedding_data['embeddings_mentions'], self.corpus_file, splitting=self.splitting,
+                lazy=self.lazy_paragraphs, vocab_key=self._vocab_key(embedding_data['embeddings_mentions_list']))
+            if self.shrink_vocab:
+                shrunk = sample_vocab.shrink_vocab(embedding_data['embeddings_mentions_list'],
+                                                   embedding_data['embeddings_np'], data_sets, self.shrink_vocab_top_k)
+                embedding_data, data_sets = dict(zip(EMBEDDING_ATTRIBUTES, shrunk[:-1])), shrunk[-1]
+            _data_cache[key] = self.vectors, embedding_data, data_sets
+
+        _, embedding_data, data_sets = _data_cache[key]
+        data = dict(embedding_data)
+        data.update(zip(DATA_SET_ATTRIBUTES, data_sets))
+        return data
+
+
+class TestConfigToy(LazyDataConfig):
+    def __init__(self, location="data/embedding_data/toy_embeddings_epoche_99_lr_1e-05_vectors.bin", vectors=None):
+        super(TestConfigToy, self).__init__(location, vectors)
         self.init_scale = 0.1
         self.learning_rate = 0.001
         self.num_layers = 2
@@ -30,12 +144,10 @@ class TestConfigToy(object):
         self.lr_decay = 0.99  # 1 / 1.15 # 0.5
         self.batch_size = 10
         self.test_batch_size = 10
-        self.vocab_size = 10000
-        self.embedding_dim = 300
+        self.max_vocab_size = 10000
         self.rnn_mode = BLOCK
         self.epoch_size = 1
         self.file_count = -1
-        self.location = "data/embedding_data/toy_embeddings_epoche_99_lr_1e-05_vectors"
         self.cpu = "/cpu:0"
         self.gpu = "/cpu:0"
         self.min_doc_length = 50
@@ -46,13 +158,14 @@ class TestConfigToy(object):
         self.max_gradient_norm = 5.0
         self.train_dir = "data/dCNN/"
         self.steps_per_checkpoint = 100
-        self.vocab_size, self.embedding_dim, self.embeddings_mentions_list, self.embeddings_mentions, self.embeddings_np = get_embedding_data(
-            self.location, self.vocab_size)
-        self.train_set, self.test_set, self.validation_set = data_utils.sentences_train_test_validation_splitting_and_paragraph_generation(
-            self.embeddings_mentions, 'data/text_data/raw_sentences.txt', splitting=(70, 20, 10))
-        self.train_args = (self.batch_size, self.buckets, self.train_set)
-        self.test_args = (self.test_batch_size, self.buckets, self.test_set)
+        self.loader_workers = 4
+        self.loader_prefetch = 8
+        self.input_mode = 'feed'  # or 'dataset' for tf.data iterators
+        self.decoder_mode = 'bucketed'  # or 'dynamic' for one while_loop decoder over all lengths
+        self.update_mode = 'bucket'  # or 'shared' for one update picking the bucket's loss at run time
         self.generator = data_utils.toy_text_generator
         self.static = True
+        self.encoder_engine = 'conv2d'  # or 'conv1d' for 1-D dilated convolutions over the exact receptive field
+        self.bucket_caps = False  # True to size the encoder input and layers of every bucket to its length
 
         self.teacher_forcing = True
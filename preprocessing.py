@@ -1,5 +1,68 @@
 import os
-import cPickle
+import re
+import time
+import hashlib
+from six.moves import cPickle
+
+# Cached artifacts are named <prefix>.cache_<key>..., the key hashing everything they were built from.
+_CACHE_KEY = re.compile(r'\.cache_([0-9a-f]{16})')
+
+
+def file_identity(file_name):
+    stat = os.stat(file_name)
+    return os.path.abspath(file_name), stat.st_size, repr(stat.st_mtime)
+
+
+def digest(value):
+    """Hex digest of the repr of value, e.g. of the sorted items of a vocabulary dict."""
+    return hashlib.sha1(repr(value).encode('utf-8')).hexdigest()
+
+
+def cache_path(prefix, files=(), **params):
+    """Path prefix for an artifact built from files with params.
+
+    The key hashes the path, size and modification time of every input file and
+    the repr of the params, so changing any of them gives a new path instead of
+    silently reusing a stale artifact.
+    """
+    key = digest(([file_identity(file_name) for file_name in files], sorted(params.items())))
+    return prefix + '.cache_' + key[:16]
+
+
+def touch(paths):
+    """Marks cached files as used, which protects them from evict_cache by age."""
+    for path in paths:
+        os.utime(path, None)
+
+
+def evict_cache(directory, max_bytes=None, max_age=None):
+    """Deletes cached artifacts of directory, least recently used first.
+
+    All files of one cache key are deleted together, those not used for max_age
+    seconds and then as many as needed to bring the cache below max_bytes.
+
+    Returns:
+      The number of deleted files.
+    """
+    artifacts = {}
+    for name in os.listdir(directory):
+        match = _CACHE_KEY.search(name)
+        if match and not name.endswith('.tmp'):
+            artifacts.setdefault(match.group(1), []).append(os.path.join(directory, name))
+
+    artifacts = sorted((max(os.path.getmtime(path) for path in paths), sum(os.path.getsize(path) for path in paths),
+                        paths) for paths in artifacts.values())
+    total_bytes = sum(size for _, size, _ in artifacts)
+    now = time.time()
+
+    deleted = 0
+    for used, size, paths in artifacts:
+        if (max_age is not None and now - used > max_age) or (max_bytes is not None and total_bytes > max_bytes):
+            for path in paths:
+                os.remove(path)
+            total_bytes -= size
+            deleted += len(paths)
+    return deleted
 
 
 def pickle_call(file_name):
@@ -12,7 +75,6 @@ def pickle_call(file_name):
 
 
 def pickle_dump(file_name, data):
-    with open(file_name, "wb") as output_file:
-        cPickle.dump(data, output_file)
-
-
+    with open(file_name + '.tmp', "wb") as output_file:
+        cPickle.dump(data, output_file, cPickle.HIGHEST_PROTOCOL)
+    os.rename(file_name + '.tmp', file_name)
@@ -0,0 +1,95 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import re
+import numpy as np
+import tensorflow as tf
+
+BASIC = "basic"
+CUDNN = "cudnn"
+BLOCK = "block"
+
+# The scope every engine creates its kernel and bias under, renamed to lstm_cell in checkpoints.
+_CELL_SCOPE = re.compile(r'(^|/)(basic_lstm_cell|cudnn_compatible_lstm_cell|lstm_cell)/')
+_LSTM_BIAS = re.compile(r'(^|/)(basic_lstm_cell|cudnn_compatible_lstm_cell|lstm_cell)/bias(:0)?$')
+
+
+def lstm_cell(rnn_mode, num_units):
+    """LSTM cell of the rnn_mode engine.
+
+    BASIC is the Python BasicLSTMCell, BLOCK the LSTMBlockCell running one fused
+    kernel per step and CUDNN the CudnnCompatibleLSTMCell, which holds the weights
+    of a CudnnLSTM and runs on CPU. All of them use one [input + units, 4 * units]
+    kernel and one bias with the gates in the order i, c, f, o. The forget bias is
+    kept in the bias variable instead of being added by the cell, as the cuDNN
+    layout requires, see forget_bias_getter.
+    """
+    if rnn_mode == BASIC:
+        return tf.contrib.rnn.BasicLSTMCell(num_units, forget_bias=0.0)
+    if rnn_mode == BLOCK:
+        return tf.contrib.rnn.LSTMBlockCell(num_units, forget_bias=0.0)
+    if rnn_mode == CUDNN:
+        return tf.contrib.cudnn_rnn.CudnnCompatibleLSTMCell(num_units)
+    raise ValueError("unknown rnn_mode %r" % (rnn_mode,))
+
+
+def forget_bias_getter(getter, name, *args, **kwargs):
+    """Custom getter initializing the forget gates of the LSTM biases to 1."""
+    shape = kwargs.get('shape')
+    if _LSTM_BIAS.search(name) and shape is not None:
+        num_units = int(shape[0]) // 4
+        kwargs['initializer'] = tf.constant_initializer([0.0] * 2 * num_units + [1.0] * num_units + [0.0] * num_units)
+    return getter(name, *args, **kwargs)
+
+
+def forget_bias_scope():
+    """Re-enters the current variable scope with forget_bias_getter."""
+    return tf.variable_scope(tf.get_variable_scope(), custom_getter=forget_bias_getter)
+
+
+def checkpoint_name(variable):
+    """Engine independent checkpoint name of a variable."""
+    return _CELL_SCOPE.sub(r'\1lstm_cell/', variable.op.name)
+
+
+def saver_variables(variables):
+    """{checkpoint name: variable} for a Saver, so a checkpoint of one engine restores in the others."""
+    return dict((checkpoint_name(variable), variable) for variable in variables)
+
+
+def _legacy_name(name):
+    """Name of a cell variable in checkpoints written by BasicLSTMCell before the engines shared names."""
+    return re.sub(r'(^|/)lstm_cell/', r'\1basic_lstm_cell/', name)
+
+
+def restore(session, variables, checkpoint_path):
+    """Restores variables from a checkpoint of any engine.
+
+    Checkpoints written by BasicLSTMCell before the engines shared their names
+    are read under the old names. Their cells added a forget bias of 1, which is
+    moved into the restored bias variables.
+
+    Returns:
+      False, after printing a warning and restoring nothing, if the checkpoint
+      lacks a variable or holds it in another shape.
+    """
+    stored = dict(tf.train.list_variables(checkpoint_path))
+    var_list, legacy_biases = {}, []
+    for name, variable in sorted(saver_variables(variables).items()):
+        if name not in stored and _legacy_name(name) in stored:
+            name = _legacy_name(name)
+            if _LSTM_BIAS.search(name):
+                legacy_biases.append(variable)
+        if name not in stored or list(stored[name]) != variable.shape.as_list():
+            print("Checkpoint %s does not match variable %s, ignoring it." % (checkpoint_path, variable.op.name))
+            return False
+        var_list[name] = variable
+
+    tf.train.Saver(var_list).restore(session, checkpoint_path)
+    for bias in legacy_biases:
+        num_units = bias.shape[0].value // 4
+        forget_bias = np.zeros(4 * num_units, dtype=bias.dtype.base_dtype.as_numpy_dtype)
+        forget_bias[2 * num_units:3 * num_units] = 1.0
+        session.run(bias.assign_add(forget_bias))
+    return True
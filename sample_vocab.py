@@ -1,52 +1,16 @@
 
 import numpy as np
 import re
+import data_utils as data_utils
+from data_utils import load_embedding_store
+from six.moves import xrange  # pylint: disable=redefined-builtin
 
 
 def get_embedding_data(location, vocab_size):
-        embeddings_mentions = {}
-        embeddings_mentions_list = []
-        embeddings = []
-
-        print("retrieving embeddings from file")
-
-        with open(location, 'r') as f:
-            for i, line in (enumerate(f)):
-
-                if i != 0:
-
-                    chunk = line.split(' ')
-                    mention = chunk[0]
-                    embedding = np.append(np.array([0.0, 0.0], dtype=np.float64),
-                                          np.array([float(j) for j in chunk[1:]], dtype=np.float64))
-
-                    if i == 1:
-                        eol = np.zeros(len(embedding), dtype=np.float64)
-                        eol[0] = 1.0
-                        start = np.zeros(len(embedding), dtype=np.float64)
-                        start[1] = 1.0
-                        pad = np.zeros(len(embedding), dtype=np.float64)
-                        embeddings.append(eol)
-                        embeddings.append(start)
-                        embeddings.append(pad)
-                        embeddings_mentions['!EOL!'] = 0
-                        embeddings_mentions['!START!'] = 1
-                        embeddings_mentions['!PAD!'] = 2
-                        embeddings_mentions_list.append('!EOL!')
-                        embeddings_mentions_list.append('!START!')
-                        embeddings_mentions_list.append('!PAD!')
-
-                    embeddings_mentions_list.append(mention)
-
-                    embeddings_mentions[mention] = i + 2
-                    embeddings.append(embedding)
-                if i == vocab_size:
-                    break
+        embeddings_mentions_list, embeddings_mentions, embeddings_np = load_embedding_store(location, vocab_size)
+
         vocab_size = len(embeddings_mentions)
-        embedding_dim = len(embeddings[0])
-        embeddings_mentions_list = embeddings_mentions_list
-        embeddings_mentions = embeddings_mentions
-        embeddings_np = np.array(embeddings)
+        embedding_dim = embeddings_np.shape[1]
 
         print('embeddings retrieved')
 
@@ -62,45 +26,66 @@ def tokenize(text):
 
 def build_new_vocab_set(new_vocab_list, embeddings_mentions, embeddings_np):
 
-        new_embeddings_mentions = {}
-        new_embeddings_mentions_list = []
-        new_embeddings = []
+        positions = np.array([embeddings_mentions[mention] for mention in new_vocab_list], dtype=np.int64)
+        return select_vocab(positions, new_vocab_list, embeddings_np)
 
-        eol = np.zeros(len(embeddings_np[0]), dtype=np.float64)
-        eol[0] = 1.0
-        start = np.zeros(len(embeddings_np[0]), dtype=np.float64)
-        start[1] = 1.0
-        pad = np.zeros(len(embeddings_np[0]), dtype=np.float64)
-        new_embeddings.append(eol)
-        new_embeddings.append(start)
-        new_embeddings.append(pad)
-        new_embeddings_mentions['!EOL!'] = 0
-        new_embeddings_mentions['!START!'] = 1
-        new_embeddings_mentions['!PAD!'] = 2
-        new_embeddings_mentions_list.append('!EOL!')
-        new_embeddings_mentions_list.append('!START!')
-        new_embeddings_mentions_list.append('!PAD!')
 
-        i = len(new_embeddings_mentions_list)
+def select_vocab(positions, mentions, embeddings_np):
+        """Embedding data of the rows at positions, after the !EOL!, !START! and !PAD! rows."""
+        new_embeddings_np = np.empty((len(positions) + 3, embeddings_np.shape[1]), dtype=embeddings_np.dtype)
+        embeddings_mentions_list = data_utils.init_special_rows(new_embeddings_np) + list(mentions)
+        new_embeddings_np[3:] = embeddings_np[positions]
+        embeddings_mentions = dict(zip(embeddings_mentions_list, xrange(len(embeddings_mentions_list))))
 
-        for mention in new_vocab_list:
-            position = embeddings_mentions[mention]
-            embedding = embeddings_np[position]
+        return len(embeddings_mentions_list), new_embeddings_np.shape[1], embeddings_mentions_list, embeddings_mentions, new_embeddings_np
 
-            new_embeddings.append(embedding)
-            new_embeddings_mentions[mention] = i
-            new_embeddings_mentions_list.append(mention)
 
-            i+= 1
+def _flat_corpus(data_set):
+        return data_set.sentences if isinstance(data_set, data_utils.ParagraphStream) else data_set
 
 
-        vocab_size = len(new_embeddings_mentions_list)
-        embedding_dim = len(new_embeddings[0])
-        embeddings_mentions_list = new_embeddings_mentions_list
-        embeddings_mentions = new_embeddings_mentions
-        embeddings_np = np.array(new_embeddings)
+def remap_corpus(corpus, remap):
+        """Re-ids a FlatCorpus through remap, dropping the tokens mapped to -1."""
+        tokens = remap[corpus.tokens]
+        kept = tokens >= 0
+        kept_before = np.zeros(len(tokens) + 1, dtype=np.int64)
+        np.cumsum(kept, out=kept_before[1:])
+        return data_utils.FlatCorpus(tokens[kept], kept_before[corpus.offsets])
 
-        return vocab_size, embedding_dim, embeddings_mentions_list, embeddings_mentions, embeddings_np
 
+def shrink_vocab(embeddings_mentions_list, embeddings_np, data_sets, top_k=None):
+        """Restricts the vocabulary to the words of the training data.
+
+        Token frequencies are counted on the first of data_sets, the training split, and
+        all words it contains, or only its top_k most frequent ones, are kept in their
+        original order after the three special rows. The embedding matrix is cut down by
+        fancy indexing and all data sets are re-ided, dropping the words that were not
+        kept like unknown mentions are dropped when encoding text. Lazy ParagraphStream
+        data sets get their sentences re-ided.
+
+        Returns:
+          vocab_size, embedding_dim, embeddings_mentions_list, embeddings_mentions and
+          embeddings_np like data_utils.get_embedding_data, plus the re-ided data sets.
+        """
+        counts = np.bincount(_flat_corpus(data_sets[0]).tokens, minlength=len(embeddings_mentions_list))
+        counts[:3] = 0
+
+        positions = np.flatnonzero(counts)
+        if top_k is not None and len(positions) > top_k:
+            positions = np.sort(positions[np.argsort(-counts[positions], kind='mergesort')[:top_k]])
+
+        remap = np.full(len(embeddings_mentions_list), -1, dtype=np.int32)
+        remap[:3] = np.arange(3)
+        remap[positions] = np.arange(3, len(positions) + 3)
+
+        new_data_sets = []
+        for data_set in data_sets:
+            corpus = remap_corpus(_flat_corpus(data_set), remap)
+            if isinstance(data_set, data_utils.ParagraphStream):
+                corpus = data_utils.ParagraphStream(corpus, data_set.nr_paragraphs, data_set.max_sentences,
+                                                    data_set.seed, data_set.chunk_size)
+            new_data_sets.append(corpus)
 
+        print(str(len(positions) + 3) + ' of ' + str(len(embeddings_mentions_list)) + ' embeddings kept')
 
+        return select_vocab(positions, [embeddings_mentions_list[i] for i in positions], embeddings_np) + (new_data_sets,)